@@ -1,139 +1,541 @@
-"""Asset handling functions for downloading and processing images and fonts."""
+"""Asset handling functions for downloading and processing images, fonts and media."""
 import os
+import re
 import json
+import io
+import math
 import base64
+import shutil
 import hashlib
-import requests
-from PIL import Image
+import asyncio
+import threading
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from PIL import Image, ImageChops, ImageStat
+from utils import download_file, hash_file
+from finalize import asset_exists
+from instrumentation import tracer
+from metrics import metrics
+from ratelimit import limiter, CircuitOpenError
 
+# Pillow >= 11.3 encodes AVIF natively, older versions need pillow-avif-plugin
+try:
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
 
-async def makeLocalImages(page, hostname, forceDownloadAgain):
-    """Download all images from the page and convert them to local WebP files."""
-    # Create images folder if it doesn't exist in hostname folder
-    if not os.path.exists(hostname + '/images'):
-        os.makedirs(hostname + '/images')
+Image.init()
+AVIF_SUPPORTED = 'AVIF' in Image.SAVE
 
-    # Download all images
-    imageLinks = await page.querySelectorAllEval('img', 'nodes => nodes.map(n => n.src)')
-    
-    # Track mapping of original src to local filename
-    image_mapping = {}
 
-    for link in imageLinks:
-        # Skip empty links
-        if not link:
+# Widths (in pixels) offered in every srcset, on top of the widths the
+# browser actually rendered the image at
+DEFAULT_RESPONSIVE_WIDTHS = [320, 640, 960, 1280, 1920]
+
+# Formats tried for every image, the smallest one that looks good enough wins.
+# "original" keeps the downloaded file as-is.
+DEFAULT_IMAGE_FORMATS = ['avif', 'webp', 'original']
+DEFAULT_IMAGE_QUALITIES = [80, 60]
+# Minimum PSNR (in dB) against the original for a lossy encoding to be accepted
+DEFAULT_MIN_IMAGE_QUALITY = 32
+
+# Where encoding decisions are cached between pages and runs
+DEFAULT_CACHE_DIR = '.wixscraper_cache'
+
+# Hex digits of the original's content hash added to every image written, as Wix gives every crop and
+# size of an image the same filename
+IMAGE_HASH_LENGTH = 8
+
+# Longest side, in pixels, of the inline placeholder shown while an image loads
+PLACEHOLDER_SIZE = 16
+
+# Original formats every browser can show, and the Pillow format used to re-encode them
+BROWSER_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'gif': 'GIF', 'webp': 'WEBP'}
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png', 'gif': 'image/gif'}
+
+_encodeExecutor = None
+# Image encoding caches, one per cacheDir, as sites in a batch can each set their own
+_encodeCaches = {}
+_encodeCacheLock = threading.Lock()
+# Results of processImage for this run, keyed by (output folder, src, rendered width)
+_processedImages = {}
+# One lock per shared download or original, so sites crawled at the same time fetch each file once
+_sharedLocks = {}
+_sharedLocksLock = threading.Lock()
+# Shared downloads already refreshed this run when forceDownloadAgain is set
+_sharedRefreshed = set()
+# Fonts copied into each site this run, keyed by (output folder, font file name)
+_localFonts = set()
+
+
+def getEncodeExecutor():
+    """Return the thread pool images are downloaded and encoded on."""
+    global _encodeExecutor
+    if _encodeExecutor is None:
+        _encodeExecutor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix='encode')
+    return _encodeExecutor
+
+
+def loadEncodeCache(cacheDir):
+    """Load the image encoding cache, which maps source URLs to content hashes and content hashes to encoding decisions."""
+    with _encodeCacheLock:
+        if cacheDir not in _encodeCaches:
+            cache = {'urls': {}, 'decisions': {}}
+            try:
+                with open(cacheDir + '/image-encodings.json', encoding='utf-8') as f:
+                    cache.update(json.load(f))
+            except (OSError, ValueError):
+                pass
+            _encodeCaches[cacheDir] = cache
+        return _encodeCaches[cacheDir]
+
+
+def saveEncodeCache(cacheDir):
+    """Write the image encoding cache back to disk."""
+    if cacheDir not in _encodeCaches:
+        return
+    if not os.path.exists(cacheDir):
+        os.makedirs(cacheDir)
+    with _encodeCacheLock:
+        with open(cacheDir + '/image-encodings.json', 'w', encoding='utf-8') as f:
+            json.dump(_encodeCaches[cacheDir], f)
+
+
+def chooseBreakpoints(intrinsicWidth, renderedWidth, widths):
+    """Pick the srcset widths for an image from its intrinsic and rendered width."""
+    candidates = set(w for w in widths if w < intrinsicWidth)
+
+    # Cover 1x and 2x screens at the width the layout actually used
+    if renderedWidth:
+        for density in (1, 2):
+            width = int(round(renderedWidth * density))
+            if 0 < width < intrinsicWidth:
+                candidates.add(width)
+
+    breakpoints = []
+    for width in sorted(candidates):
+        # Widths within 10% of the previous one save next to nothing
+        if breakpoints and width < breakpoints[-1] * 1.1:
             continue
+        breakpoints.append(width)
+    return breakpoints
 
-        # Handle data URIs (data:image/...)
-        if link.startswith('data:'):
+
+def encodeImage(im, fmt, quality):
+    """Encode a decoded image in an output format ("avif", "webp" or a key of BROWSER_FORMATS) and return the bytes."""
+    buffer = io.BytesIO()
+    if fmt == 'avif':
+        im.save(buffer, 'AVIF', quality=quality)
+    elif fmt == 'webp':
+        im.save(buffer, 'WEBP', quality=quality)
+    elif BROWSER_FORMATS[fmt] == 'JPEG':
+        im.convert('RGB').save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+    else:
+        im.save(buffer, BROWSER_FORMATS[fmt], optimize=True)
+    return buffer.getvalue()
+
+
+def measureQuality(reference, encoded):
+    """Return the PSNR (in dB) of encoded image bytes against the decoded reference image."""
+    with Image.open(io.BytesIO(encoded)) as decoded:
+        decoded = decoded.convert(reference.mode)
+    stat = ImageStat.Stat(ImageChops.difference(reference, decoded))
+    mse = sum(stat.sum2) / (reference.width * reference.height * len(reference.getbands()))
+    if mse == 0:
+        return float('inf')
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+def chooseEncoding(im, originalExt, originalSize, formats, qualities, minQuality):
+    """Try every format/quality pair and return the smallest acceptable one and a fallback for plain <img>.
+
+    Both are (format, quality) pairs, format "original" meaning the downloaded file.
+    """
+    reference = im.convert('RGBA' if 'A' in im.getbands() or 'transparency' in im.info else 'RGB')
+    candidates = []
+    if 'original' in formats and originalExt in BROWSER_FORMATS:
+        candidates.append((originalSize, 'original', None))
+    for fmt in formats:
+        if fmt not in ('avif', 'webp') or (fmt == 'avif' and not AVIF_SUPPORTED):
+            continue
+        for quality in qualities:
             try:
-                # Extract the data URI parts: data:image/png;base64,<data>
-                header, data = link.split(',', 1)
-                # Get the image format from the header
-                if 'base64' in header:
-                    # Decode base64 data
-                    image_data = base64.b64decode(data)
-                    # Generate a filename from the hash of the data
-                    image_hash = hashlib.md5(image_data).hexdigest()
-                    # Try to get format from header (e.g., image/png, image/svg+xml)
-                    if 'svg' in header:
-                        imageName = image_hash + '.svg'
-                        ext = 'svg'
-                    elif 'png' in header:
-                        imageName = image_hash + '.png'
-                        ext = 'png'
-                    elif 'jpeg' in header or 'jpg' in header:
-                        imageName = image_hash + '.jpg'
-                        ext = 'jpg'
-                    elif 'gif' in header:
-                        imageName = image_hash + '.gif'
-                        ext = 'gif'
-                    elif 'webp' in header:
-                        imageName = image_hash + '.webp'
-                        ext = 'webp'
-                    else:
-                        # Default to png if format unknown
-                        imageName = image_hash + '.png'
-                        ext = 'png'
-                    
-                    # Check if already exists
-                    if not forceDownloadAgain and os.path.exists(hostname + '/images/' + image_hash + '.webp'):
-                        image_mapping[link] = image_hash + '.webp'
-                        continue
-                    
-                    # Save the decoded image
-                    with open(hostname + '/images/' + imageName, 'wb') as f:
-                        f.write(image_data)
-                    
-                    # Convert to WebP if not already WebP and not SVG (SVG can't be converted)
-                    if ext != 'webp' and ext != 'svg':
-                        try:
-                            im = Image.open(hostname + '/images/' + imageName)
-                            im.save(hostname + '/images/' + image_hash + '.webp', 'webp')
-                            # Delete the original
-                            os.remove(hostname + '/images/' + imageName)
-                            image_mapping[link] = image_hash + '.webp'
-                        except Exception as e:
-                            print(f"Warning: Could not convert data URI image to WebP: {e}")
-                            # Keep the original format if conversion fails
-                            image_mapping[link] = imageName
-                    elif ext == 'svg':
-                        # SVG files can't be converted to WebP, keep as SVG
-                        image_mapping[link] = imageName
-                    else:
-                        image_mapping[link] = image_hash + '.webp'
-                else:
-                    # Non-base64 data URI, skip for now
-                    print(f"Warning: Skipping non-base64 data URI: {link[:50]}...")
-                    continue
+                encoded = encodeImage(reference, fmt, quality)
             except Exception as e:
-                print(f"Warning: Error processing data URI image: {e}")
-                continue
+                print(f"Warning: Could not encode image as {fmt}: {e}")
+                break
+            if measureQuality(reference, encoded) >= minQuality:
+                candidates.append((len(encoded), fmt, quality))
+
+    candidates.sort(key=lambda candidate: candidate[0])
+    fallbacks = [candidate for candidate in candidates if candidate[1] != 'avif']
+    if fallbacks:
+        fallback = fallbacks[0][1:]
+    elif originalExt in BROWSER_FORMATS:
+        fallback = ('original', None)
+    else:
+        # Nothing a plain <img> can show passed, use WebP at the best quality tried
+        fallback = ('webp', max(qualities))
+    best = candidates[0][1:] if candidates else fallback
+    return list(best), list(fallback)
+
+
+def makePlaceholder(im):
+    """Return a tiny base64 WebP version of a decoded image, used as a placeholder while the real one loads."""
+    thumbnail = im.convert('RGBA' if 'A' in im.getbands() or 'transparency' in im.info else 'RGB')
+    thumbnail.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, 'WEBP', quality=30)
+    return 'data:image/webp;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def writeImageFile(path, data):
+    """Write image bytes through a temporary file so a half-written image is never left behind."""
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def writeEncodedImage(outputDir, im, image_base, originalName, originalPath, fmt, quality, renderedWidth, widths, forceDownloadAgain):
+    """Write an image and its downscaled srcset variants in one format, returning (src, srcset)."""
+    ext = originalName.rsplit('.', 1)[-1].lower() if fmt == 'original' else fmt
+    mainName = image_base + '.' + ext
+    if forceDownloadAgain or not asset_exists(outputDir, '/images/' + mainName):
+        if fmt == 'original':
+            shutil.copyfile(originalPath, outputDir + '/images/' + mainName + '.tmp')
+            os.replace(outputDir + '/images/' + mainName + '.tmp', outputDir + '/images/' + mainName)
         else:
-            # Regular HTTP/HTTPS image URL
-            try:
-                # Get the image name
-                imageName = link.split('/')[-1].split('?')[0].split('#')[0]  # Remove query params and fragments
-                if not imageName or '.' not in imageName:
-                    # Generate name from URL hash if no filename
-                    image_hash = hashlib.md5(link.encode()).hexdigest()
-                    imageName = image_hash + '.jpg'  # Default extension
-                
-                # If a webp version of the image already exists, skip it
-                image_base = imageName.rsplit('.', 1)[0] if '.' in imageName else imageName
-                if not forceDownloadAgain and os.path.exists(hostname + '/images/' + image_base + '.webp'):
-                    image_mapping[link] = image_base + '.webp'
-                    continue
-
-                # Fetch each image and save it to the images folder
-                # Download using requests
-                r = requests.get(link, allow_redirects=True, timeout=10)
-                r.raise_for_status()  # Raise an exception for bad status codes
-                
-                with open(hostname + '/images/' + imageName, 'wb') as f:
-                    f.write(r.content)
-
-                # Convert each image to WebP (skip SVG files)
-                file_ext = imageName.rsplit('.', 1)[-1].lower() if '.' in imageName else ''
-                if file_ext == 'svg':
-                    # SVG files can't be converted to WebP, keep as SVG
-                    image_mapping[link] = imageName
-                else:
-                    try:
-                        im = Image.open(hostname + '/images/' + imageName)
-                        im.save(hostname + '/images/' + image_base + '.webp', 'webp')
-                        # Delete the original image
-                        os.remove(hostname + '/images/' + imageName)
-                        image_mapping[link] = image_base + '.webp'
-                    except Exception as e:
-                        print(f"Warning: Could not convert {imageName} to WebP: {e}")
-                        # Keep original if conversion fails
-                        image_mapping[link] = imageName
-            except Exception as e:
-                print(f"Warning: Error downloading image {link}: {e}")
-                continue
+            writeImageFile(outputDir + '/images/' + mainName, encodeImage(im, ext, quality))
+
+    entries = []
+    for width in chooseBreakpoints(im.width, renderedWidth, widths):
+        variantName = image_base + '-' + str(width) + 'w.' + ext
+        if forceDownloadAgain or not asset_exists(outputDir, '/images/' + variantName):
+            height = max(1, round(im.height * width / im.width))
+            writeImageFile(outputDir + '/images/' + variantName, encodeImage(im.resize((width, height), Image.LANCZOS), ext, quality or 85))
+        entries.append('/images/' + variantName + ' ' + str(width) + 'w')
+
+    srcset = None
+    if entries:
+        srcset = ', '.join(entries + ['/images/' + mainName + ' ' + str(im.width) + 'w'])
+    return '/images/' + mainName, srcset
+
+
+def sharedLock(path):
+    """Return the lock guarding a download to path, which sites crawled at the same time may share."""
+    with _sharedLocksLock:
+        return _sharedLocks.setdefault(path, threading.Lock())
+
+
+def fetchImage(link, originalsDir, maxSize=None, reserved=False):
+    """Decode or download an image src into the originals cache, returning (imageName, path, sha1 of the contents).
+
+    Sites in a batch share the originals cache, so the download is locked: two sites using the same image
+    would otherwise stream into the same partial file.
+    """
+    if link.startswith('data:'):
+        # Extract the data URI parts: data:image/png;base64,<data>
+        header, data = link.split(',', 1)
+        if 'base64' not in header:
+            raise ValueError('non-base64 data URI')
+        image_data = base64.b64decode(data)
+        # Generate a filename from the hash of the data
+        image_hash = hashlib.md5(image_data).hexdigest()
+        # Get the format from the header (e.g., image/png, image/svg+xml), default to png if unknown
+        imageName = image_hash + '.png'
+        for ext in ('svg', 'png', 'gif', 'webp'):
+            if ext in header:
+                imageName = image_hash + '.' + ext
+        if 'jpeg' in header or 'jpg' in header:
+            imageName = image_hash + '.jpg'
+        downloadPath = originalsDir + '/' + imageName + '.download'
+    else:
+        imageName = imageNameFromLink(link)
+        downloadPath = originalsDir + '/' + hashlib.md5(link.encode()).hexdigest() + '.download'
+
+    with sharedLock(downloadPath):
+        if link.startswith('data:'):
+            writeImageFile(downloadPath, image_data)
+        else:
+            # Regular HTTP/HTTPS image URL, streamed to disk (and resumed if an earlier attempt was cut off)
+            download_file(link, downloadPath, maxSize, reserved=reserved)
+
+        # Originals are stored by content, so the same image under different URLs is only encoded once
+        content_hash = hash_file(downloadPath)
+        path = originalsDir + '/' + content_hash + '.' + imageName.rsplit('.', 1)[-1]
+        os.replace(downloadPath, path)
+    return imageName, path, content_hash
+
+
+def fetchShared(link, path, cacheDir, forceDownloadAgain, maxSize=None, timeout=30):
+    """Download link to path through the download cache shared by every site in cacheDir.
+
+    Wix serves the same fonts and media to many sites, so a file fetched for one site is copied
+    for the next instead of being downloaded again. Runs on a worker thread.
+    """
+    cachePath = cacheDir + '/shared/' + hashlib.sha1(link.encode()).hexdigest()
+    with sharedLock(cachePath):
+        if forceDownloadAgain and cachePath not in _sharedRefreshed and os.path.exists(cachePath):
+            os.remove(cachePath)
+        if not os.path.exists(cachePath):
+            os.makedirs(cacheDir + '/shared', exist_ok=True)
+            download_file(link, cachePath, maxSize, timeout)
+            tracer.count('shared_downloads')
+        else:
+            tracer.count('shared_hits')
+        _sharedRefreshed.add(cachePath)
+    shutil.copyfile(cachePath, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def svgDimensions(path):
+    """Return the intrinsic (width, height) of an SVG as strings, from its width and height in pixels or else its viewBox.
+
+    Returns None if the root element has neither, or the file can't be parsed.
+    """
+    try:
+        for _, root in ElementTree.iterparse(path, events=('start',)):
+            break
+        else:
+            return None
+    except (ElementTree.ParseError, OSError):
+        return None
+
+    def pixels(value):
+        match = re.fullmatch(r'\s*([0-9.]+)\s*(px)?\s*', value or '')
+        return match and float(match.group(1)) > 0 and float(match.group(1))
+
+    width, height = pixels(root.get('width')), pixels(root.get('height'))
+    if not (width and height):
+        # Relative sizes (100%, 2em) say nothing about the aspect ratio, the viewBox does
+        viewBox = re.split(r'[\s,]+', (root.get('viewBox') or '').strip())
+        try:
+            width, height = float(viewBox[2]), float(viewBox[3])
+        except (IndexError, ValueError):
+            return None
+        if width <= 0 or height <= 0:
+            return None
+    return str(round(width)), str(round(height))
+
+
+def imageNameFromLink(link):
+    """Return the local filename for an image URL."""
+    imageName = link.split('/')[-1].split('?')[0].split('#')[0]  # Remove query params and fragments
+    if not imageName or '.' not in imageName:
+        # Generate name from URL hash if no filename
+        imageName = hashlib.md5(link.encode()).hexdigest() + '.jpg'  # Default extension
+    return imageName
+
+
+def cachedOriginal(link, options, forceDownloadAgain):
+    """Return the (imageName, path, sha1) of the original of an image src downloaded on an earlier page or run, or None."""
+    if forceDownloadAgain or link.startswith('data:'):
+        return None
+    originalsDir = options['cacheDir'] + '/originals'
+    cache = loadEncodeCache(options['cacheDir'])
+    with _encodeCacheLock:
+        cached = cache['urls'].get(link)
+    if not cached:
+        return None
+    path = originalsDir + '/' + cached['hash'] + '.' + cached['name'].rsplit('.', 1)[-1]
+    return (cached['name'], path, cached['hash']) if os.path.exists(path) else None
+
+
+def fetchOriginal(link, options, reserved=False):
+    """Decode or download an image src into the originals cache and remember it, returning (imageName, path, sha1).
+
+    Runs on a worker thread, not the encode pool, so waiting on a slow or throttled host never holds up encoding.
+    """
+    originalsDir = options['cacheDir'] + '/originals'
+    os.makedirs(originalsDir, exist_ok=True)
+    with tracer.span('download', category='download', url=link[:200]):
+        imageName, originalPath, image_hash = fetchImage(link, originalsDir, options.get('maxDownloadSize'), reserved)
+    if not link.startswith('data:'):
+        cache = loadEncodeCache(options['cacheDir'])
+        with _encodeCacheLock:
+            cache['urls'][link] = {'name': imageName, 'hash': image_hash}
+    return imageName, originalPath, image_hash
+
+
+def processImage(link, original, outputDir, renderedWidth, options, forceDownloadAgain):
+    """Encode and write one image from its original, returning the attributes and <picture> sources for its <img>.
+
+    Runs on the encode thread pool.
+    """
+    cache = loadEncodeCache(options['cacheDir'])
+    imageName, originalPath, image_hash = original
+
+    # Named after the original's contents too, so different images with the same filename never share files
+    image_base = imageName.rsplit('.', 1)[0] + '-' + image_hash[:IMAGE_HASH_LENGTH]
+    originalExt = imageName.rsplit('.', 1)[-1].lower()
+
+    # SVG files can't be rasterized by Pillow, keep as SVG
+    if originalExt == 'svg':
+        if forceDownloadAgain or not asset_exists(outputDir, '/images/' + image_base + '.svg'):
+            shutil.copyfile(originalPath, outputDir + '/images/' + image_base + '.svg')
+        attributes = {'src': '/images/' + image_base + '.svg'}
+        dimensions = svgDimensions(originalPath)
+        if dimensions:
+            attributes['width'], attributes['height'] = dimensions
+        return {'attributes': attributes, 'sources': [], 'placeholder': None}
+
+    decisionKey = image_hash + ':' + ','.join(options['imageFormats']) + ':' + ','.join(str(q) for q in options['imageQualities']) + ':' + str(options['minImageQuality'])
+
+    with tracer.span('encode', category='encode', image=imageName), Image.open(originalPath) as im:
+        im.load()
+        animated = getattr(im, 'is_animated', False)
+        if im.mode not in ('RGB', 'RGBA'):
+            im = im.convert('RGBA' if 'A' in im.getbands() or 'transparency' in im.info else 'RGB')
+
+        with _encodeCacheLock:
+            decision = cache['decisions'].get(decisionKey)
+        if decision is None:
+            if animated and originalExt in BROWSER_FORMATS:
+                # Only the first frame would survive re-encoding
+                decision = {'best': ['original', None], 'fallback': ['original', None]}
+            else:
+                with tracer.span('choose_encoding', category='encode', image=imageName):
+                    best, fallback = chooseEncoding(im, originalExt, os.path.getsize(originalPath), options['imageFormats'], options['imageQualities'], options['minImageQuality'])
+                tracer.count('encoded_images')
+                decision = {'best': best, 'fallback': fallback}
+            with _encodeCacheLock:
+                cache['decisions'][decisionKey] = decision
+
+        # Resizing would keep only the first frame of an animation
+        widths = [] if animated else options['responsiveWidths']
+        renderedWidth = None if animated else renderedWidth
+
+        attributes = {'width': str(im.width), 'height': str(im.height)}
+        src, srcset = writeEncodedImage(outputDir, im, image_base, imageName, originalPath, decision['fallback'][0], decision['fallback'][1], renderedWidth, widths, forceDownloadAgain)
+        attributes['src'] = src
+        if srcset:
+            attributes['srcset'] = srcset
+
+        # A winner that not every browser can show goes in a <source> ahead of the plain <img>
+        sources = []
+        if decision['best'] != decision['fallback']:
+            bestSrc, bestSrcset = writeEncodedImage(outputDir, im, image_base, imageName, originalPath, decision['best'][0], decision['best'][1], renderedWidth, widths, forceDownloadAgain)
+            sources.append({'type': MIME_TYPES[decision['best'][0]], 'srcset': bestSrcset or bestSrc})
+
+        placeholder = makePlaceholder(im)
+
+    return {'attributes': attributes, 'sources': sources, 'placeholder': placeholder}
+
+
+async def makeLocalImages(page, hostname, forceDownloadAgain, imageOptions=None, maxDownloadSize=None, outputDir=None):
+    """Download all images from the page, encode each in its smallest acceptable format and give them a responsive srcset.
+
+    Returns the attributes and <picture> sources of the LCP candidate image, or None if no image is above the fold.
+    """
+    options = {
+        'responsiveWidths': DEFAULT_RESPONSIVE_WIDTHS,
+        'imageFormats': DEFAULT_IMAGE_FORMATS,
+        'imageQualities': DEFAULT_IMAGE_QUALITIES,
+        'minImageQuality': DEFAULT_MIN_IMAGE_QUALITY,
+        'cacheDir': DEFAULT_CACHE_DIR,
+    }
+    options.update(imageOptions or {})
+    options['maxDownloadSize'] = maxDownloadSize
+
+    # Create images folder if it doesn't exist in the site's folder
+    outputDir = outputDir or hostname
+    if not os.path.exists(outputDir + '/images'):
+        os.makedirs(outputDir + '/images')
+
+    # Download all images, remembering the widest size each one was rendered at
+    # and whether it shows up above the fold. The page is scrolled back to the top first, as fixed and sticky
+    # elements are only where a first visit sees them there ('instant', in case the site sets smooth scrolling)
+    await page.evaluate("() => window.scrollTo({top: 0, left: 0, behavior: 'instant'})")
+    images = await page.querySelectorAllEval('img', '''nodes => nodes.map(n => {
+        const rect = n.getBoundingClientRect();
+        const visibleHeight = Math.max(0, Math.min(rect.bottom, window.innerHeight) - Math.max(rect.top, 0));
+        return {src: n.src, width: rect.width, aboveFold: rect.top < window.innerHeight && rect.width > 0 && rect.height > 0, visibleArea: rect.width * visibleHeight};
+    })''')
+    renderedWidths = {}
+    aboveFold = set()
+    lcpCandidate = None
+    lcpArea = 0
+    for image in images:
+        renderedWidths[image['src']] = max(renderedWidths.get(image['src'], 0), image['width'] or 0)
+        if image['aboveFold']:
+            aboveFold.add(image['src'])
+            # The largest image painted in the first viewport is the likely LCP element
+            if image['visibleArea'] > lcpArea:
+                lcpCandidate = image['src']
+                lcpArea = image['visibleArea']
+
+    # Skip empty and non-base64 data URI links
+    imageLinks = []
+    for link in renderedWidths:
+        if not link:
+            continue
+        if link.startswith('data:') and 'base64' not in link.split(',', 1)[0]:
+            print(f"Warning: Skipping non-base64 data URI: {link[:50]}...")
+            continue
+        imageLinks.append(link)
+
+    # Download and encode every image in parallel, each is only processed once per rendered width
+    loop = asyncio.get_event_loop()
+
+    async def downloadAndEncode(link):
+        original = cachedOriginal(link, options, forceDownloadAgain)
+        if original is None:
+            # Wait for the host's slot here, so downloads are paced without blocking any thread
+            reserved = not link.startswith('data:')
+            if reserved:
+                await limiter.acquire(link)
+            original = await loop.run_in_executor(None, fetchOriginal, link, options, reserved)
+        metrics.inc('encode_queue_depth')
+        try:
+            return await loop.run_in_executor(getEncodeExecutor(), processImage, link, original, outputDir, renderedWidths[link], options, forceDownloadAgain)
+        finally:
+            metrics.inc('encode_queue_depth', -1)
+
+    pending = {}
+    for link in imageLinks:
+        key = (outputDir, link, round(renderedWidths[link]))
+        if key not in _processedImages:
+            pending[key] = downloadAndEncode(link)
+    results = await asyncio.gather(*pending.values(), return_exceptions=True)
+    for key, result in zip(pending, results):
+        if isinstance(result, Exception):
+            print(f"Warning: Error processing image {key[1][:100]}: {result}")
+            continue
+        _processedImages[key] = result
+    saveEncodeCache(options['cacheDir'])
 
-    # Replace all image links with the local image links, using the webp format
+    # If a host's circuit is open, fail the page so it is saved again once the host recovers, not with remote images
+    for result in results:
+        if isinstance(result, CircuitOpenError):
+            raise result
+
+    # Build the attributes of every local image: a responsive srcset, intrinsic dimensions to reserve
+    # layout space, a blurred placeholder, lazy loading below the fold and <picture> sources
+    image_mapping = {}
+    for link in imageLinks:
+        processed = _processedImages.get((outputDir, link, round(renderedWidths[link])))
+        if processed is None:
+            continue
+        attributes = dict(processed['attributes'])
+        attributes['decoding'] = 'async'
+        if 'srcset' in attributes:
+            renderedWidth = round(renderedWidths[link])
+            if renderedWidth:
+                attributes['sizes'] = '(max-width: ' + str(renderedWidth) + 'px) 100vw, ' + str(renderedWidth) + 'px'
+            else:
+                attributes['sizes'] = '100vw'
+        if link == lcpCandidate:
+            attributes['loading'] = 'eager'
+            attributes['fetchpriority'] = 'high'
+        elif link in aboveFold:
+            attributes['loading'] = 'eager'
+        else:
+            attributes['loading'] = 'lazy'
+        sources = [dict(source, sizes=attributes.get('sizes', '100vw')) for source in processed['sources']]
+        image_mapping[link] = {'attributes': attributes, 'sources': sources, 'placeholder': processed['placeholder']}
+
+    # Replace all image links with the local image links
     # Convert mapping to JSON for JavaScript
     mapping_json = json.dumps(image_mapping)
     
@@ -141,35 +543,298 @@ async def makeLocalImages(page, hostname, forceDownloadAgain):
         const imageMapping = {mapping_json};
         const elements = document.querySelectorAll('img');
         for (const element of elements) {{
-            const originalSrc = element.src;
-            if (imageMapping[originalSrc]) {{
-                element.src = '/images/' + imageMapping[originalSrc];
-            }} else {{
-                // Fallback for images not in mapping (shouldn't happen, but handle gracefully)
-                try {{
-                    const filename = originalSrc.split('/').slice(-1)[0].split('.')[0];
-                    if (filename && filename !== '') {{
-                        element.src = '/images/' + filename + '.webp';
-                    }}
-                }} catch (e) {{
-                    console.warn('Could not process image src:', originalSrc);
-                }}
+            const image = imageMapping[element.src];
+            // Images that couldn't be downloaded keep pointing at Wix, srcset and all
+            if (!image) {{
+                continue;
             }}
-            // remove any srcset
+            // Wix srcsets point at its own CDN and its priority hints at its own LCP guess, drop them before adding ours
             element.removeAttribute('srcset');
+            element.removeAttribute('sizes');
+            element.removeAttribute('fetchpriority');
+            // Same for the <source>s of a Wix <picture>
+            if (element.parentNode && element.parentNode.tagName === 'PICTURE') {{
+                for (const source of element.parentNode.querySelectorAll('source')) {{
+                    source.parentNode.removeChild(source);
+                }}
+            }}
+            for (const name in image.attributes) {{
+                element.setAttribute(name, image.attributes[name]);
+            }}
+            // Offer formats not every browser supports through a <picture>
+            if (image.sources.length && element.parentNode) {{
+                let picture = element.parentNode;
+                if (picture.tagName !== 'PICTURE') {{
+                    picture = document.createElement('picture');
+                    element.parentNode.insertBefore(picture, element);
+                    picture.appendChild(element);
+                }}
+                for (const source of image.sources) {{
+                    const sourceElement = document.createElement('source');
+                    sourceElement.type = source.type;
+                    sourceElement.srcset = source.srcset;
+                    sourceElement.sizes = source.sizes;
+                    picture.insertBefore(sourceElement, element);
+                }}
+            }}
+            // Show the placeholder as a stretched background until the real image has loaded
+            if (image.placeholder) {{
+                element.style.backgroundImage = 'url(' + image.placeholder + ')';
+                element.style.backgroundSize = 'cover';
+                element.style.backgroundRepeat = 'no-repeat';
+                element.setAttribute('onload', "this.style.removeProperty('background-image')");
+            }}
         }}
     }}''')
 
+    return image_mapping.get(lcpCandidate)
+
+
+# Extensions of the media files (background videos, documents) made local by makeMediaLocal
+MEDIA_EXTENSIONS = ('mp4', 'webm', 'mov', 'm4v', 'mp3', 'pdf')
+# Hosts Wix serves videos and uploaded documents from (and their subdomains), on top of the site itself
+MEDIA_HOSTS = ('wixstatic.com', 'filesusr.com', 'parastorage.com')
+
+
+async def makeMediaLocal(page, hostname, forceDownloadAgain, maxDownloadSize=None, cacheDir=DEFAULT_CACHE_DIR, outputDir=None):
+    """Download videos and linked documents (e.g. PDFs) from the page and make them local.
+
+    Only media from the site and Wix's own hosts is downloaded, links to other sites are left alone.
+    Files are streamed to disk, so large media doesn't need to fit in memory. Anything over
+    maxDownloadSize bytes keeps pointing at Wix.
+    """
+    outputDir = outputDir or hostname
+    loop = asyncio.get_event_loop()
+    mediaLinks = await page.evaluate('''() => {
+        const links = [];
+        for (const element of document.querySelectorAll('video[src], video source[src], audio[src], audio source[src]')) {
+            links.push(element.src);
+        }
+        for (const element of document.querySelectorAll('a[href]')) {
+            links.push(element.href);
+        }
+        return links;
+    }''')
+
+    media_mapping = {}
+    for link in set(mediaLinks):
+        if not link.startswith('http'):
+            continue
+        host = urlparse(link).hostname or ''
+        if host.replace('www.', '', 1) != hostname.replace('www.', '', 1) and not any(host == mediaHost or host.endswith('.' + mediaHost) for mediaHost in MEDIA_HOSTS):
+            continue
+        ext = link.split('/')[-1].split('?')[0].split('#')[0].rsplit('.', 1)[-1].lower()
+        if ext not in MEDIA_EXTENSIONS:
+            continue
+        # Wix names every video file.mp4 (.../<id>/<resolution>/mp4/file.mp4), so name them after the whole URL
+        mediaName = hashlib.md5(link.encode()).hexdigest() + '.' + ext
+
+        # Create media folder if it doesn't exist in the site's folder
+        if not os.path.exists(outputDir + '/media'):
+            os.makedirs(outputDir + '/media')
+
+        if forceDownloadAgain or not asset_exists(outputDir, '/media/' + mediaName):
+            try:
+                await loop.run_in_executor(None, fetchShared, link, outputDir + '/media/' + mediaName, cacheDir, forceDownloadAgain, maxDownloadSize, 60)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                print(f"Warning: Error downloading media {link}: {e}")
+                continue
+        media_mapping[link] = '/media/' + mediaName
+
+    # Replace the media links with the local ones
+    await page.evaluate('''(mediaMapping) => {
+        for (const element of document.querySelectorAll('video[src], video source[src], audio[src], audio source[src]')) {
+            if (mediaMapping[element.src]) {
+                element.setAttribute('src', mediaMapping[element.src]);
+            }
+        }
+        for (const element of document.querySelectorAll('a[href]')) {
+            if (mediaMapping[element.href]) {
+                element.setAttribute('href', mediaMapping[element.href]);
+            }
+        }
+    }''', media_mapping)
+
+
+# Characters kept in every font subset, so text added after the crawl still renders
+BASE_FONT_CHARACTERS = ''.join(chr(c) for c in range(0x20, 0x7f))
+
+# Source formats fontTools can subset, best first
+SUBSETTABLE_FONT_FORMATS = ['woff2', 'woff', 'otf', 'ttf']
+
+
+def fontNameFromUrl(link):
+    """Return the local filename of a font from its url(...) reference."""
+    # Get the font name
+    fontName = link.split('/')[-1].split(')')[0]
+    # Remove any ? parameters
+    fontName = fontName.split('?')[0]
+    # Remove any # parameters
+    fontName = fontName.split('#')[0]
+    # Remove any " and '
+    return fontName.replace('"', '').replace("'", '')
+
+
+def parseFontFaces(css):
+    """Return the family, weight, style and font filenames of every @font-face rule in a stylesheet."""
+    faces = []
+    for rule in re.findall(r'@font-face\s*\{[^}]*\}', css):
+        family = re.search(r'font-family\s*:\s*([^;}]+)', rule)
+        if not family:
+            continue
+        weight = re.search(r'font-weight\s*:\s*([^;}]+)', rule)
+        style = re.search(r'font-style\s*:\s*([^;}]+)', rule)
+        faces.append({
+            'family': normalizeFontFamily(family.group(1)),
+            'weight': normalizeFontWeight(weight.group(1) if weight else 'normal'),
+            'style': style.group(1).strip() if style else 'normal',
+            'files': [fontNameFromUrl(link) for link in re.findall(r'url\((.*?)\)', rule)],
+        })
+    return faces
+
+
+def normalizeFontFamily(family):
+    """Normalize a font-family name for comparison."""
+    return family.strip().strip('"\'').strip().lower()
+
 
-async def makeFontsLocal(page, hostname, forceDownloadAgain):
-    """Download all fonts from the page and make them local."""
+def normalizeFontWeight(weight):
+    """Normalize a font-weight value to its number, as getComputedStyle reports it."""
+    weight = weight.strip().lower()
+    return {'normal': '400', 'bold': '700'}.get(weight, weight)
+
+
+def fontMimeType(fontName):
+    """Return the MIME type of a font file for preload hints, or None for legacy formats."""
+    return {'woff2': 'font/woff2', 'woff': 'font/woff', 'ttf': 'font/ttf', 'otf': 'font/otf'}.get(fontName.rsplit('.', 1)[-1].lower())
+
+
+async def makeFontsLocal(page, hostname, forceDownloadAgain, fontUsage=None, maxDownloadSize=None, cacheDir=DEFAULT_CACHE_DIR, outputDir=None):
+    """Download all fonts from the page, make them local and drop the @font-face rules the page doesn't use.
+
+    If fontUsage is given, the characters rendered in each font family and the files of each
+    @font-face rule are added to it for optimizeFonts.
+
+    Returns the local URLs of the fonts rendering text above the fold, most used first.
+    """
     # Make all fonts local
-    # Create a fonts folder if it doesn't exist in hostname folder
-    if not os.path.exists(hostname + '/fonts'):
-        os.makedirs(hostname + '/fonts')
+    # Create a fonts folder if it doesn't exist in the site's folder
+    outputDir = outputDir or hostname
+    if not os.path.exists(outputDir + '/fonts'):
+        os.makedirs(outputDir + '/fonts')
+
+    # Collect every family named by any element, the text rendered in each family, and how much
+    # above-the-fold text each web font face renders, measured with the page scrolled back to the top
+    usage = await page.evaluate('''() => {
+        window.scrollTo({top: 0, left: 0, behavior: 'instant'});
+        const normalize = family => family.trim().replace(/^["']|["']$/g, '').trim().toLowerCase();
+        const webFonts = new Set();
+        document.fonts.forEach(font => webFonts.add(normalize(font.family)));
+        const aboveFold = {};
+        const families = new Set();
+        const characters = {};
+        // Fallback families in the stack render glyphs the first one lacks
+        const addText = (fontFamily, text) => {
+            for (const name of fontFamily.split(',').map(normalize)) {
+                characters[name] = (characters[name] || '') + text;
+            }
+        };
+        // The text as rendered, uppercased or lowercased by text-transform and small caps
+        const transformed = (text, style) => {
+            if (style.textTransform === 'uppercase' || style.fontVariantCaps.includes('caps')) {
+                return text + text.toUpperCase();
+            }
+            if (style.textTransform === 'lowercase') {
+                return text + text.toLowerCase();
+            }
+            if (style.textTransform === 'capitalize') {
+                return text + text.toUpperCase();
+            }
+            return text;
+        };
+        for (const element of document.querySelectorAll('*')) {
+            for (const family of getComputedStyle(element).fontFamily.split(',')) {
+                families.add(normalize(family));
+            }
+            // Generated content, which is how icon fonts draw their glyphs
+            for (const pseudo of ['::before', '::after']) {
+                const style = getComputedStyle(element, pseudo);
+                const strings = (style.content || '').match(/"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'/g);
+                if (!strings) {
+                    continue;
+                }
+                for (const family of style.fontFamily.split(',')) {
+                    families.add(normalize(family));
+                }
+                addText(style.fontFamily, transformed(strings.map(string => string.slice(1, -1).replace(/\\(.)/g, '$1')).join(''), style));
+            }
+        }
+        const walker = document.createTreeWalker(document.body, NodeFilter.SHOW_TEXT);
+        while (walker.nextNode()) {
+            const text = walker.currentNode.nodeValue;
+            const parent = walker.currentNode.parentElement;
+            if (!parent || !text.trim()) {
+                continue;
+            }
+            const style = getComputedStyle(parent);
+            const stack = style.fontFamily.split(',').map(normalize);
+            addText(style.fontFamily, transformed(text, style));
+            const face = stack.find(name => webFonts.has(name));
+            if (face && parent.getBoundingClientRect().top < window.innerHeight) {
+                const key = face + '|' + style.fontWeight + '|' + style.fontStyle;
+                aboveFold[key] = (aboveFold[key] || 0) + text.trim().length;
+            }
+        }
+        for (const name in characters) {
+            characters[name] = Array.from(new Set(characters[name])).join('');
+        }
+        return {families: Array.from(families), characters: characters, aboveFold: aboveFold};
+    }''')
+    usedFamilies = set(usage['families'])
+
+    # Drop the @font-face rules of families no element uses
+    await page.evaluate('''(usedFamilies) => {
+        const normalize = family => family.trim().replace(/^["']|["']$/g, '').trim().toLowerCase();
+        for (const element of document.querySelectorAll('style')) {
+            if (!element.innerText.includes('@font-face')) {
+                continue;
+            }
+            element.innerText = element.innerText.replace(/@font-face\\s*\\{[^}]*\\}/g, rule => {
+                const family = rule.match(/font-family\\s*:\\s*([^;}]+)/);
+                return !family || usedFamilies.includes(normalize(family[1])) ? rule : '';
+            });
+        }
+    }''', list(usedFamilies))
+
+    styles = await page.querySelectorAllEval('style', 'nodes => nodes.map(n => n.innerText)')
+
+    if fontUsage is not None:
+        fontUsage.setdefault('families', set()).update(usedFamilies)
+        allCharacters = fontUsage.setdefault('characters', {})
+        for family, characters in usage['characters'].items():
+            allCharacters[family] = ''.join(sorted(set(allCharacters.get(family, '')) | set(characters)))
+        for css in styles:
+            for face in parseFontFaces(css):
+                fontUsage.setdefault('faces', {})[' '.join(face['files'])] = {'family': face['family'], 'files': face['files']}
+
+    # Find the file behind each above-the-fold face, preferring an exact weight/style match
+    faces = [face for css in styles for face in parseFontFaces(css)]
+    criticalFonts = []
+    for key, count in sorted(usage['aboveFold'].items(), key=lambda item: -item[1]):
+        family, weight, style = key.split('|')
+        matches = [face for face in faces if face['family'] == family]
+        exact = [face for face in matches if face['weight'] == weight and face['style'] == style]
+        for face in exact or matches[:1]:
+            files = [name for name in face['files'] if fontMimeType(name)]
+            if files:
+                best = min(files, key=lambda name: SUBSETTABLE_FONT_FORMATS.index(name.rsplit('.', 1)[-1].lower()))
+                if '/fonts/' + best not in criticalFonts:
+                    criticalFonts.append('/fonts/' + best)
 
     # Download all fonts, which are parastorage links
-    fontLinks = await page.querySelectorAllEval('style', 'nodes => nodes.map(n => n.innerText.match(/url\\((.*?)\\)/g)).flat()')
+    fontLinks = [link for css in styles for link in re.findall(r'url\((.*?)\)', css)]
 
     # Get all url("//static.parastorage.com...") links
     fontLinks = [link for link in fontLinks if link is not None and 'static.parastorage.com' in link]
@@ -182,21 +847,22 @@ async def makeFontsLocal(page, hostname, forceDownloadAgain):
         # Remove anything before the link
         link = link.split('static.parastorage.com')[1]
         link = 'static.parastorage.com' + link
-        # Get the font name
-        fontName = link.split('/')[-1].split(')')[0]
-        # Remove any ? parameters
-        fontName = fontName.split('?')[0]
-        # Remove any # parameters
-        fontName = fontName.split('#')[0]
-        # Remove any "
-        fontName = fontName.replace('"', '')
+        fontName = fontNameFromUrl(link)
         
-        # If the font already exists, skip it
-        if(not forceDownloadAgain and os.path.exists(hostname + '/fonts/' + fontName)):
+        # Copy each font from the download cache once per run, even if the site folder has it: that may be
+        # the subset an earlier run made, and optimizeFonts must start from the original
+        if (outputDir, fontName) in _localFonts:
             continue
         
-        r = requests.get("https://" + link, allow_redirects=True)
-        open(hostname + '/fonts/' + fontName, 'wb').write(r.content)
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, fetchShared, "https://" + link.split(')')[0].replace('"', '').replace("'", ''), outputDir + '/fonts/' + fontName, cacheDir, forceDownloadAgain, maxDownloadSize)
+            _localFonts.add((outputDir, fontName))
+            if fontUsage is not None:
+                fontUsage.setdefault('originals', set()).add(fontName)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            print(f"Warning: Error downloading font {fontName}: {e}")
 
     # Replace all font links with the local font links where the font file name is the last item after the last slash
     await page.evaluate('''() => {
@@ -213,7 +879,8 @@ async def makeFontsLocal(page, hostname, forceDownloadAgain):
                             
                         // Get the font name
                         // in javascript, not using split
-                        var fontName = link.substring(link.lastIndexOf('/') + 1, link.lastIndexOf(')')); 
+                        // without query parameters, fragments or quotes, the same as the downloaded file
+                        var fontName = link.substring(link.lastIndexOf('/') + 1, link.lastIndexOf(')')).split('?')[0].split('#')[0].replace(/["']/g, ''); 
 
                         // Redo the src link
                         element.innerText = element.innerText.replace(link, 'url("/fonts/' + fontName + '")');
@@ -223,3 +890,106 @@ async def makeFontsLocal(page, hostname, forceDownloadAgain):
             }
         }
     }''')
+
+    return criticalFonts
+
+def subsetFont(outputDir, source, output, text):
+    """Subset a downloaded font to the characters in text and write it as WOFF2, returning whether it worked."""
+    from fontTools import subset
+
+    options = subset.Options()
+    options.flavor = 'woff2'
+    options.layout_features = ['*']
+    options.notdef_outline = True
+    try:
+        font = subset.load_font(outputDir + '/fonts/' + source, options)
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(text=text)
+        subsetter.subset(font)
+        subset.save_font(font, outputDir + '/fonts/' + output + '.tmp', options)
+        os.replace(outputDir + '/fonts/' + output + '.tmp', outputDir + '/fonts/' + output)
+    except Exception as e:
+        print(f"Warning: Could not subset font {source}: {e}")
+        return False
+    return True
+
+
+def optimizeFonts(outputDir, fontUsage):
+    """Subset every downloaded font to the characters rendered in it across the site and convert it to WOFF2.
+
+    Run once after all pages are saved: every @font-face rule in the saved pages is pointed at the single
+    WOFF2 file, and rules (and files) of families never rendered are removed. Only fonts freshly copied
+    from the download cache this run are subset, never an earlier run's subset, and faces used without
+    any text seen in them (e.g. icons drawn some other way) are kept whole.
+    """
+    try:
+        import fontTools.subset  # noqa: F401
+        import brotli  # noqa: F401  (needed by fontTools for WOFF2)
+    except ImportError:
+        print("Warning: fonttools and brotli are needed to subset fonts. Keeping fonts as downloaded.")
+        return
+
+    characters = fontUsage.get('characters', {})
+    families = fontUsage.get('families', set())
+    originals = fontUsage.get('originals', set())
+    renames = {}
+    unused = set()
+    for face in fontUsage.get('faces', {}).values():
+        files = [name for name in face['files'] if os.path.exists(outputDir + '/fonts/' + name)]
+        if not files:
+            continue
+        if face['family'] not in families and face['family'] not in characters:
+            unused.update(files)
+            continue
+        if not characters.get(face['family'], '').strip():
+            continue
+
+        sources = [name for name in files if name.rsplit('.', 1)[-1].lower() in SUBSETTABLE_FONT_FORMATS and name in originals]
+        if not sources:
+            continue
+        source = min(sources, key=lambda name: SUBSETTABLE_FONT_FORMATS.index(name.rsplit('.', 1)[-1].lower()))
+        output = source.rsplit('.', 1)[0] + '.woff2'
+
+        with tracer.span('subset_font', category='fonts', font=source):
+            if not subsetFont(outputDir, source, output, characters[face['family']] + BASE_FONT_CHARACTERS):
+                continue
+
+        for name in files:
+            renames[name] = output
+
+    # Point every @font-face at its WOFF2 subset, and drop the unused ones
+    def rewriteFontFace(match):
+        rule = match.group(0)
+        files = [fontNameFromUrl(link) for link in re.findall(r'url\((.*?)\)', rule)]
+        if files and all(name in unused for name in files):
+            return ''
+        for name in files:
+            if name in renames:
+                return re.sub(r'src\s*:[^;}]*', 'src: url("/fonts/' + renames[name] + '") format("woff2")', rule)
+        return rule
+
+    # Same for font preload hints
+    def rewritePreload(match):
+        tag = match.group(0)
+        name = match.group(1)
+        if name in renames:
+            return tag.replace('/fonts/' + name, '/fonts/' + renames[name]).replace('type="' + str(fontMimeType(name)) + '"', 'type="font/woff2"')
+        if name in unused:
+            return ''
+        return tag
+
+    for folder, _, filenames in os.walk(outputDir):
+        for filename in filenames:
+            if not filename.endswith('.html'):
+                continue
+            with open(folder + '/' + filename, encoding='utf-8') as f:
+                html = f.read()
+            html = re.sub(r'@font-face\s*\{[^}]*\}', rewriteFontFace, html)
+            html = re.sub(r'<link rel="preload" href="/fonts/([^"]+)"[^>]*>', rewritePreload, html)
+            with open(folder + '/' + filename, 'w', encoding='utf-8') as f:
+                f.write(html)
+
+    # Remove the originals that were replaced or never used
+    for name in set(renames) | unused:
+        if renames.get(name) != name and os.path.exists(outputDir + '/fonts/' + name):
+            os.remove(outputDir + '/fonts/' + name)
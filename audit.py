@@ -0,0 +1,247 @@
+"""Performance-budget auditor for an exported site.
+
+Walks the output folder of a crawl and computes, per page, the weight of its HTML, CSS, JS, images and
+fonts, the third-party origins it loads from, its render-blocking resources and the images missing
+width/height. Results are checked against the "budgets" in config.json and written as JSON and Markdown.
+
+    python audit.py [config.json]
+
+Exits non-zero if any page is over budget.
+"""
+import os
+import re
+import sys
+import json
+from html.parser import HTMLParser
+from urllib.parse import urlparse
+from utils import page_url
+
+
+# Budget keys, and the page metric each one caps. Weights are in KB.
+BUDGET_METRICS = {
+    'totalKB': 'total',
+    'htmlKB': 'html',
+    'cssKB': 'css',
+    'jsKB': 'js',
+    'imagesKB': 'images',
+    'fontsKB': 'fonts',
+    'thirdPartyOrigins': 'thirdPartyOrigins',
+    'renderBlockingResources': 'renderBlockingResources',
+    'imagesMissingDimensions': 'imagesMissingDimensions',
+}
+
+
+def srcset_urls(srcset):
+    """Return the URL of every candidate in a srcset, which may contain commas (data: URIs)."""
+    urls = []
+    position = 0
+    while position < len(srcset):
+        # Skip the whitespace and commas between candidates
+        while position < len(srcset) and (srcset[position].isspace() or srcset[position] == ','):
+            position += 1
+        start = position
+        while position < len(srcset) and not srcset[position].isspace():
+            position += 1
+        url = srcset[start:position]
+        if url.endswith(','):
+            url = url.rstrip(',')
+        else:
+            # Skip the width or density descriptor, up to the comma ending the candidate
+            while position < len(srcset) and srcset[position] != ',':
+                position += 1
+        if url:
+            urls.append(url)
+    return urls
+
+
+class PageParser(HTMLParser):
+    """Collects the resources an exported page loads."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.inHead = True
+        self.inStyle = False
+        self.inScript = False
+        self.css = ''
+        self.inlineJs = 0
+        self.stylesheets = []
+        self.scripts = []
+        # The candidate URLs of each image: its src, srcset and the srcsets of its <picture>'s <source>s
+        self.images = []
+        self.pictureSources = None
+        self.resources = []
+        self.renderBlocking = []
+        self.imagesMissingDimensions = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'body':
+            self.inHead = False
+        elif tag == 'style':
+            self.inStyle = True
+        elif tag == 'script':
+            self.inScript = True
+            if attrs.get('src'):
+                self.scripts.append(attrs['src'])
+                self.resources.append(attrs['src'])
+                if self.inHead and 'async' not in attrs and 'defer' not in attrs and attrs.get('type') != 'module':
+                    self.renderBlocking.append(attrs['src'])
+        elif tag == 'link' and attrs.get('href'):
+            rel = (attrs.get('rel') or '').lower().split()
+            if 'stylesheet' in rel:
+                self.stylesheets.append(attrs['href'])
+                self.resources.append(attrs['href'])
+                if self.inHead and attrs.get('media', 'all') in ('all', 'screen') and 'onload' not in attrs:
+                    self.renderBlocking.append(attrs['href'])
+            elif 'preload' in rel or 'icon' in rel or 'manifest' in rel:
+                self.resources.append(attrs['href'])
+        elif tag == 'picture':
+            self.pictureSources = []
+        elif tag == 'img':
+            src = attrs.get('src') or ''
+            candidates = [src] + srcset_urls(attrs.get('srcset') or '') + (self.pictureSources or [])
+            self.images.append(tuple(candidates))
+            self.resources.extend(candidates)
+            if not attrs.get('width') or not attrs.get('height'):
+                self.imagesMissingDimensions.append(src)
+        elif tag == 'source' and self.pictureSources is not None:
+            candidates = srcset_urls(attrs.get('srcset') or '')
+            self.pictureSources.extend(candidates)
+            self.resources.extend(candidates)
+        elif tag in ('source', 'iframe', 'video', 'audio', 'embed'):
+            for name in ('src', 'srcset'):
+                if attrs.get(name):
+                    self.resources.append(attrs[name].split()[0])
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.inHead = False
+        elif tag == 'style':
+            self.inStyle = False
+        elif tag == 'script':
+            self.inScript = False
+        elif tag == 'picture':
+            self.pictureSources = None
+
+    def handle_data(self, data):
+        if self.inStyle:
+            self.css += data
+        elif self.inScript:
+            self.inlineJs += len(data.encode('utf-8'))
+
+
+def is_local(url, hostname):
+    """Return whether a URL points inside the exported site."""
+    parsed = urlparse(url)
+    if parsed.scheme == 'data':
+        return True
+    return not parsed.netloc or parsed.hostname in (hostname, 'www.' + hostname)
+
+
+def local_size(root, url):
+    """Return the size of the exported file a local URL points at, or 0 if it is missing."""
+    path = os.path.join(root, urlparse(url).path.lstrip('/'))
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def audit_page(root, hostname, path):
+    """Return the weight breakdown and findings of one exported page."""
+    with open(path, encoding='utf-8') as f:
+        html = f.read()
+    parser = PageParser()
+    parser.feed(html)
+
+    inlineCss = len(parser.css.encode('utf-8'))
+    fontUrls = set(url.strip('\'" ') for url in re.findall(r'@font-face\s*\{[^}]*?url\(([^)]*)\)', parser.css))
+    css = inlineCss + sum(local_size(root, url) for url in parser.stylesheets if is_local(url, hostname))
+    js = parser.inlineJs + sum(local_size(root, url) for url in parser.scripts if is_local(url, hostname))
+    # The browser fetches one candidate of each image, count the largest
+    images = sum(max([local_size(root, url) for url in candidates if url and is_local(url, hostname) and not url.startswith('data:')] or [0])
+                 for candidates in set(parser.images))
+    fonts = sum(local_size(root, url) for url in fontUrls if is_local(url, hostname))
+    htmlBytes = len(html.encode('utf-8')) - inlineCss - parser.inlineJs
+
+    origins = sorted(set(urlparse(url).netloc for url in parser.resources + list(fontUrls) if url and not is_local(url, hostname)))
+    return {
+        'page': page_url(root, path),
+        'total': htmlBytes + css + js + images + fonts,
+        'html': htmlBytes,
+        'css': css,
+        'js': js,
+        'images': images,
+        'fonts': fonts,
+        'thirdPartyOrigins': len(origins),
+        'origins': origins,
+        'renderBlockingResources': len(parser.renderBlocking),
+        'renderBlocking': parser.renderBlocking,
+        'imagesMissingDimensions': len(parser.imagesMissingDimensions),
+        'missingDimensions': [src[:100] for src in parser.imagesMissingDimensions],
+    }
+
+
+def check_budgets(page, budgets):
+    """Return a description of every budget the page is over."""
+    violations = []
+    for key, metric in BUDGET_METRICS.items():
+        if key not in budgets:
+            continue
+        limit = budgets[key] * 1024 if key.endswith('KB') else budgets[key]
+        if page[metric] > limit:
+            violations.append(f"{metric} is {format_value(key, page[metric])}, over the budget of {format_value(key, limit)}")
+    return violations
+
+
+def format_value(key, value):
+    """Format a metric for the report, weights in KB."""
+    return f"{value / 1024:.1f} KB" if key.endswith('KB') else str(value)
+
+
+def audit_site(hostname, budgets, outputDir=None):
+    """Audit every page under outputDir (by default the hostname folder) and return the report."""
+    outputDir = outputDir or hostname
+    pages = []
+    for folder, _, filenames in sorted(os.walk(outputDir)):
+        for filename in filenames:
+            if filename == 'index.html':
+                page = audit_page(outputDir, hostname, os.path.join(folder, filename))
+                page['violations'] = check_budgets(page, budgets)
+                pages.append(page)
+    return {'hostname': hostname, 'budgets': budgets, 'pages': pages, 'violations': sum(len(page['violations']) for page in pages)}
+
+
+def write_report(report, path):
+    """Write the report as <path>.json and a Markdown table as <path>.md."""
+    with open(path + '.json', 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    lines = ['# Performance audit: ' + report['hostname'], '',
+             '| Page | Total KB | HTML | CSS | JS | Images | Fonts | 3rd-party origins | Render-blocking | Images w/o size |',
+             '|---|---|---|---|---|---|---|---|---|---|']
+    for page in report['pages']:
+        lines.append('| {} | {:.1f} | {:.1f} | {:.1f} | {:.1f} | {:.1f} | {:.1f} | {} | {} | {} |'.format(
+            page['page'], page['total'] / 1024, page['html'] / 1024, page['css'] / 1024, page['js'] / 1024,
+            page['images'] / 1024, page['fonts'] / 1024, page['thirdPartyOrigins'], page['renderBlockingResources'], page['imagesMissingDimensions']))
+    lines += ['', '## Budget violations', '']
+    violations = [(page['page'], violation) for page in report['pages'] for violation in page['violations']]
+    lines += ['- `{}`: {}'.format(page, violation) for page, violation in violations] or ['None.']
+    with open(path + '.md', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def run_audit(hostname, budgets, outputDir=None):
+    """Audit the exported site, write <outputDir>.audit.json/.md, print any violations and return their number."""
+    outputDir = outputDir or hostname
+    report = audit_site(hostname, budgets, outputDir)
+    write_report(report, outputDir + '.audit')
+    for page in report['pages']:
+        for violation in page['violations']:
+            print("Budget: " + page['page'] + " " + violation)
+    print(f"Audit: {len(report['pages'])} pages, {report['violations']} budget violations. Report written to {outputDir}.audit.md")
+    return report['violations']
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1] if len(sys.argv) > 1 else 'config.json') as f:
+        data = json.load(f)
+    hostname = urlparse(data['site']).hostname
+    sys.exit(1 if run_audit(hostname, data.get('budgets', {}), data.get('outputDir', hostname)) else 0)
@@ -0,0 +1,154 @@
+"""Generates a Wix-like fixture site for the benchmark: galleries, slideshows, maps, many images, web fonts and a deep link graph."""
+import os
+import random
+from PIL import Image, ImageDraw
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+
+
+# Families declared by every page, the last one is never used and should be dropped by the scraper
+FONT_FAMILIES = ['fixture-sans', 'fixture-serif', 'fixture-unused']
+
+LOREM = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore '
+         'magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat.')
+
+# Stand-ins for the jQuery, slick and Leaflet files the scraper injects, so the run stays offline
+LIBRARY_STUBS = {
+    'jquery.min.js': 'window.jQuery = window.$ = function () { return {slick: function () {}, ready: function () {}}; };\njQuery.noConflict = function () { return jQuery; };\n',
+    'slick.min.js': '',
+    'slick.css': '',
+    'slick-theme.css': '',
+    'leaflet.js': '',
+    'leaflet.css': '',
+}
+
+
+def build_font(path, familyName, flavor=None):
+    """Write a font with a box glyph for every printable ASCII character."""
+    characters = [chr(c) for c in range(0x21, 0x7f)]
+    glyphNames = ['.notdef', 'space'] + ['uni%04X' % ord(c) for c in characters]
+
+    builder = FontBuilder(1000, isTTF=True)
+    builder.setupGlyphOrder(glyphNames)
+    cmap = {0x20: 'space'}
+    cmap.update({ord(c): 'uni%04X' % ord(c) for c in characters})
+    builder.setupCharacterMap(cmap)
+
+    glyphs = {}
+    for index, name in enumerate(glyphNames):
+        pen = TTGlyphPen(None)
+        if name != 'space':
+            # Vary the boxes a little so every glyph has its own outline
+            height = 500 + (index * 7) % 200
+            pen.moveTo((50, 0))
+            pen.lineTo((50, height))
+            pen.lineTo((450, height))
+            pen.lineTo((450, 0))
+            pen.closePath()
+        glyphs[name] = pen.glyph()
+    builder.setupGlyf(glyphs)
+    builder.setupHorizontalMetrics({name: (500, 50) for name in glyphNames})
+    builder.setupHorizontalHeader(ascent=800, descent=-200)
+    builder.setupNameTable({'familyName': familyName, 'styleName': 'Regular'})
+    builder.setupOS2(sTypoAscender=800, usWinAscent=800, usWinDescent=200)
+    builder.setupPost()
+    if flavor:
+        builder.font.flavor = flavor
+    builder.save(path)
+
+
+def build_image(path, seed, size, transparent=False):
+    """Write a noisy photo-like image (or a flat transparent logo) that doesn't compress to nothing."""
+    rng = random.Random(seed)
+    if transparent:
+        im = Image.new('RGBA', size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(im)
+        draw.ellipse((size[0] // 8, size[1] // 8, size[0] * 7 // 8, size[1] * 7 // 8), fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256), 255))
+        im.save(path, 'PNG')
+        return
+    im = Image.effect_noise(size, 40).convert('RGB')
+    draw = ImageDraw.Draw(im)
+    for _ in range(12):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.rectangle((x, y, x + size[0] // 4, y + size[1] // 4), fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    im.save(path, 'JPEG', quality=92)
+
+
+def page_path(index):
+    """Return the URL path of a fixture page."""
+    return '/' if index == 0 else '/page-' + str(index)
+
+
+def build_page(index, pages, imagesPerPage, rng):
+    """Return the HTML of one fixture page."""
+    fontFaces = ''.join(
+        '@font-face {font-family: ' + family + '; src: url("//static.parastorage.com/fonts/v2/fixture/' + family + '.woff2") format("woff2"), '
+        'url("//static.parastorage.com/fonts/v2/fixture/' + family + '.ttf") format("truetype");}\n'
+        for family in FONT_FAMILIES)
+
+    # Every page links home and to the next one (a chain as deep as the site), plus a few random pages
+    links = {0, (index + 1) % pages} | set(rng.sample(range(pages), min(3, pages)))
+    nav = ''.join('<a href="' + page_path(link) + '">Page ' + str(link) + '</a> ' for link in sorted(links))
+
+    images = ''.join(
+        '<img src="/media/photo-' + str(index) + '-' + str(i) + '.jpg" alt="" style="width: 100%; height: auto;">\n'
+        for i in range(imagesPerPage))
+
+    body = '<h1>Fixture page ' + str(index) + '</h1>\n<p>' + LOREM + '</p>\n'
+    body += '<img src="/media/logo.png" alt="Logo" style="width: 120px;">\n'
+    body += images
+    if index % 4 == 1:
+        body += ('<div><div><div class="pro-gallery">' +
+                 ''.join('<img src="/media/gallery-' + str(i) + '.jpg" alt="">' for i in range(6)) +
+                 '</div></div></div>\n')
+    if index % 4 == 2:
+        body += ('<div><div><div class="wixui-slideshow" id="slideshow' + str(index) + '">'
+                 '<div data-testid="slidesWrapper"><div><img src="/media/slide-0.jpg" alt=""></div></div>'
+                 '<nav aria-label="Slides"><ol>' +
+                 ''.join('<li style="display: inline-block; width: 20px; height: 20px;"><img src="/media/slide-' + str(i) + '.jpg" alt="" style="width: 20px;"></li>' for i in range(2)) +
+                 '</ol></nav></div></div></div>\n')
+    if index % 4 == 3:
+        body += '<div><wix-iframe title="Google Maps"><iframe title="Google Maps" src="about:blank"></iframe></wix-iframe></div>\n'
+    if index == 0:
+        body += '<a href="/docs/brochure.pdf">Brochure</a>\n'
+
+    return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Fixture ' + str(index) + '</title>\n'
+            '<style>\n' + fontFaces +
+            'body { font-family: fixture-sans, sans-serif; --wix-ads: 1; }\nh1 { font-family: fixture-serif, serif; }\n</style>\n'
+            '<link rel="stylesheet" href="/thunderbolt.css"><script src="/thunderbolt.js"></script>\n'
+            '</head><body>\n<div id="WIX_ADS"><span>Made with Wix</span></div>\n'
+            '<nav>' + nav + '</nav>\n' + body + '<footer><p>' + LOREM + '</p></footer>\n</body></html>\n')
+
+
+def build_fixture_site(root, pages=12, imagesPerPage=6, seed=1):
+    """Write the fixture site to root, with pages served as /page-<n>/index.html."""
+    rng = random.Random(seed)
+    for folder in ('media', 'docs', 'lib', 'parastorage/fonts/v2/fixture'):
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    for index in range(pages):
+        folder = root if index == 0 else os.path.join(root, 'page-' + str(index))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'index.html'), 'w', encoding='utf-8') as f:
+            f.write(build_page(index, pages, imagesPerPage, rng))
+        for i in range(imagesPerPage):
+            build_image(os.path.join(root, 'media', 'photo-' + str(index) + '-' + str(i) + '.jpg'), seed * 1000 + index * 100 + i, (1600, 1000))
+
+    build_image(os.path.join(root, 'media', 'logo.png'), seed, (256, 256), transparent=True)
+    for i in range(6):
+        build_image(os.path.join(root, 'media', 'gallery-' + str(i) + '.jpg'), seed * 7 + i, (1200, 800))
+    for i in range(2):
+        build_image(os.path.join(root, 'media', 'slide-' + str(i) + '.jpg'), seed * 13 + i, (1920, 800))
+
+    with open(os.path.join(root, 'docs', 'brochure.pdf'), 'wb') as f:
+        f.write(b'%PDF-1.4\n' + bytes(rng.randrange(256) for _ in range(200 * 1024)) + b'\n%%EOF\n')
+    for name in ('thunderbolt.css', 'thunderbolt.js'):
+        with open(os.path.join(root, name), 'w') as f:
+            f.write('/* Wix runtime stand-in */\n')
+    for name, content in LIBRARY_STUBS.items():
+        with open(os.path.join(root, 'lib', name), 'w') as f:
+            f.write(content)
+
+    for family in FONT_FAMILIES:
+        build_font(os.path.join(root, 'parastorage/fonts/v2/fixture', family + '.ttf'), family)
+        build_font(os.path.join(root, 'parastorage/fonts/v2/fixture', family + '.woff2'), family, flavor='woff2')
@@ -0,0 +1,214 @@
+"""Offline scraper benchmark.
+
+Serves the fixture site from a local HTTP server, runs scraper.main against it headlessly and reports
+pages/min, time per stage, bytes downloaded and output size. Results are compared against
+benchmarks/baseline.json and the run exits non-zero when a metric regressed by more than --tolerance.
+
+    python benchmarks/run_benchmark.py                     # run and compare
+    python benchmarks/run_benchmark.py --update-baseline   # run and store as the new baseline
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+from functools import partial
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scraper  # noqa: E402
+import page_fixes  # noqa: E402
+from utils import session  # noqa: E402
+from instrumentation import tracer  # noqa: E402
+from fixture_site import build_fixture_site  # noqa: E402
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Metrics compared against the baseline, and whether higher is better
+COMPARED_METRICS = {
+    'pages_per_minute': True,
+    'seconds': False,
+    'download_bytes': False,
+    'output_bytes': False,
+}
+
+# Stages shorter than this (total seconds) are too noisy to compare
+MIN_COMPARED_STAGE_SECONDS = 0.5
+
+# The fixture site is crawled under this hostname, which the browser and the download session send to
+# the local server. Crawling 127.0.0.1:<port> would leave the port behind in the rewritten links.
+FIXTURE_HOST = 'wixfixture.test'
+
+
+class FixtureHandler(SimpleHTTPRequestHandler):
+    """Serves /page-n as page-n/index.html without a redirect, after an optional simulated latency."""
+
+    latency = 0
+
+    def translate_path(self, path):
+        fsPath = super().translate_path(path)
+        if os.path.isdir(fsPath):
+            return os.path.join(fsPath, 'index.html')
+        return fsPath
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureAdapter(requests.adapters.HTTPAdapter):
+    """Sends requests for a remote host (e.g. static.parastorage.com) to a folder of the fixture server."""
+
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        request.url = self.base + url.path + ('?' + url.query if url.query else '')
+        return super().send(request, **kwargs)
+
+
+def start_server(root, latency):
+    """Serve root on a free local port from a background thread, returning the server."""
+    handler = partial(FixtureHandler, directory=root)
+    FixtureHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def folder_size(path):
+    """Return the total size in bytes of the files under path."""
+    return sum(os.path.getsize(os.path.join(folder, name)) for folder, _, names in os.walk(path) for name in names)
+
+
+def run(args):
+    """Run the scraper against a freshly built fixture site and return the measured results."""
+    workDir = tempfile.mkdtemp(prefix='wixscraper-benchmark-')
+    siteDir = os.path.join(workDir, 'site')
+    build_fixture_site(siteDir, pages=args.pages, imagesPerPage=args.images)
+
+    server = start_server(siteDir, args.latency / 1000)
+    local = 'http://127.0.0.1:' + str(server.server_address[1])
+    base = 'http://' + FIXTURE_HOST
+
+    # Keep the run offline: the injected libraries come from the fixture server, font downloads
+    # from its parastorage folder, and the browser's own font requests fail fast
+    page_fixes.JQUERY_URL = base + '/lib/jquery.min.js'
+    page_fixes.SLICK_CSS_URL = base + '/lib/slick.css'
+    page_fixes.SLICK_THEME_CSS_URL = base + '/lib/slick-theme.css'
+    page_fixes.SLICK_JS_URL = base + '/lib/slick.min.js'
+    page_fixes.LEAFLET_CSS_URL = base + '/lib/leaflet.css'
+    page_fixes.LEAFLET_JS_URL = base + '/lib/leaflet.js'
+    session.mount(base + '/', FixtureAdapter(local))
+    session.mount('https://static.parastorage.com/', FixtureAdapter(local + '/parastorage'))
+
+    config = {
+        'site': base + '/',
+        'blockPrimaryFolder': '',
+        'wait': 0,
+        'recursive': 'True',
+        'darkWebsite': 'False',
+        'forceDownloadAgain': 'False',
+        'headless': 'True',
+        'executablePath': args.browser,
+        'browserArgs': ['--host-resolver-rules=MAP ' + FIXTURE_HOST + ' 127.0.0.1:' + str(server.server_address[1]) + ', MAP static.parastorage.com 127.0.0.1'],
+        'traceFile': os.path.join(workDir, 'trace.json'),
+        'metatags': {},
+        'mapData': {'latitude': '0', 'longitude': '0', 'zoom': '10', 'mapMarker': {'latitude': '0', 'longitude': '0', 'popup': '<p>Fixture</p>'}},
+    }
+    configPath = os.path.join(workDir, 'config.json')
+    with open(configPath, 'w') as f:
+        json.dump(config, f)
+
+    cwd = os.getcwd()
+    os.chdir(workDir)
+    try:
+        start = time.perf_counter()
+        asyncio.run(scraper.main(configPath))
+        seconds = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+
+    stages = tracer.stage_totals()
+    pages = stages.get('page', (0, 0, 0))[0]
+    results = {
+        'pages': pages,
+        'seconds': round(seconds, 2),
+        'pages_per_minute': round(pages / seconds * 60, 2),
+        'download_bytes': tracer.counters.get('download_bytes', 0),
+        'output_bytes': folder_size(os.path.join(workDir, FIXTURE_HOST)),
+        'stages': {name: round(total, 3) for name, (count, total, longest) in stages.items()},
+    }
+
+    if args.keep:
+        print('Benchmark files kept in ' + workDir)
+    else:
+        shutil.rmtree(workDir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return a description of every metric that is more than tolerance worse than the baseline."""
+    regressions = []
+    metrics = [(name, results.get(name), baseline.get(name), higherIsBetter) for name, higherIsBetter in COMPARED_METRICS.items()]
+    for name, total in baseline.get('stages', {}).items():
+        if total >= MIN_COMPARED_STAGE_SECONDS:
+            metrics.append(('stage ' + name, results['stages'].get(name, 0), total, False))
+
+    for name, value, expected, higherIsBetter in metrics:
+        if value is None or not expected:
+            continue
+        change = (value - expected) / expected
+        if (higherIsBetter and change < -tolerance) or (not higherIsBetter and change > tolerance):
+            regressions.append(f"{name}: {value} vs baseline {expected} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=12, help='number of fixture pages')
+    parser.add_argument('--images', type=int, default=6, help='photos per fixture page')
+    parser.add_argument('--latency', type=float, default=0, help='simulated server latency per request, in ms')
+    parser.add_argument('--browser', default=None, help="browser executable (default: pyppeteer's Chromium)")
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed relative regression before failing')
+    parser.add_argument('--update-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--keep', action='store_true', help='keep the fixture site and output')
+    args = parser.parse_args()
+
+    results = run(args)
+    print(json.dumps(results, indent=2))
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Baseline written to ' + BASELINE_PATH)
+        return 0
+
+    if not os.path.exists(BASELINE_PATH):
+        print('No baseline to compare against, run with --update-baseline to store one.')
+        return 0
+    with open(BASELINE_PATH) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print('Regression: ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
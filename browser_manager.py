@@ -0,0 +1,287 @@
+"""Browser and tab lifecycle for Wix Scraper: finds and launches the browser, leases pre-warmed contexts to crawl workers,
+and recycles tabs and restarts the browser to keep memory bounded on long crawls."""
+import os
+import sys
+import shutil
+import asyncio
+from contextlib import asynccontextmanager
+from pyppeteer import launch
+from instrumentation import tracer
+from metrics import metrics
+
+# psutil measures memory on every platform, without it only Linux's /proc is read
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# Browsers looked for when config.json doesn't name one, in order of preference
+BROWSER_COMMANDS = ['chromium', 'chromium-browser', 'google-chrome', 'google-chrome-stable', 'microsoft-edge', 'microsoft-edge-stable', 'chrome', 'msedge']
+BROWSER_PATHS = {
+    'darwin': [
+        '/Applications/Chromium.app/Contents/MacOS/Chromium',
+        '/Applications/Google Chrome.app/Contents/MacOS/Google Chrome',
+        '/Applications/Microsoft Edge.app/Contents/MacOS/Microsoft Edge',
+    ],
+    'win32': [
+        os.path.expandvars('%LOCALAPPDATA%\\Chromium\\Application\\chrome.exe'),
+        os.path.expandvars('%PROGRAMFILES%\\Google\\Chrome\\Application\\chrome.exe'),
+        os.path.expandvars('%PROGRAMFILES(X86)%\\Google\\Chrome\\Application\\chrome.exe'),
+        os.path.expandvars('%LOCALAPPDATA%\\Google\\Chrome\\Application\\chrome.exe'),
+        os.path.expandvars('%PROGRAMFILES(X86)%\\Microsoft\\Edge\\Application\\msedge.exe'),
+        os.path.expandvars('%PROGRAMFILES%\\Microsoft\\Edge\\Application\\msedge.exe'),
+    ],
+}
+
+# Flags that turn off the browser features a scraper never uses (sync, extensions, updates,
+# background throttling of the tabs that aren't focused, ...) so it starts and runs leaner
+LEAN_BROWSER_ARGS = [
+    '--no-first-run',
+    '--no-default-browser-check',
+    '--disable-extensions',
+    '--disable-sync',
+    '--disable-default-apps',
+    '--disable-component-update',
+    '--disable-background-networking',
+    '--disable-background-timer-throttling',
+    '--disable-backgrounding-occluded-windows',
+    '--disable-renderer-backgrounding',
+    '--disable-dev-shm-usage',
+    '--metrics-recording-only',
+    '--mute-audio',
+]
+
+# Pages a tab loads before it is closed and replaced by a fresh one
+DEFAULT_RECYCLE_TAB_AFTER = 50
+# JavaScript heap, in megabytes, above which a tab is replaced after its current page
+DEFAULT_MAX_TAB_HEAP = 512
+# Resident memory, in megabytes, of the browser and all its processes above which it is restarted
+DEFAULT_MAX_BROWSER_RSS = 4096
+
+
+def find_browser():
+    """Return the path of a locally installed Chromium, Chrome or Edge, or None to use the Chromium pyppeteer downloads."""
+    for path in BROWSER_PATHS.get(sys.platform, []):
+        if os.path.isfile(path):
+            return path
+    for command in BROWSER_COMMANDS:
+        path = shutil.which(command)
+        if path:
+            return path
+    return None
+
+
+def process_tree_rss(pid):
+    """Return the resident memory, in bytes, of a process and all its children, or None if it can't be measured here."""
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            return sum(p.memory_info().rss for p in [process] + process.children(recursive=True))
+        except psutil.Error:
+            return None
+
+    if not os.path.isdir('/proc'):
+        return None
+    pageSize = os.sysconf('SC_PAGE_SIZE')
+    children = {}
+    rss = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/' + entry + '/stat') as f:
+                # The process name can hold spaces, the fields after it start with the state
+                fields = f.read().rsplit(')', 1)[1].split()
+            ppid, pages = int(fields[1]), int(fields[21])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+        rss[int(entry)] = pages * pageSize
+    if pid not in rss:
+        return None
+
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        total += rss.get(current, 0)
+        stack.extend(children.get(current, []))
+    return total
+
+
+class Tab:
+    """A browser context leased by a crawl worker, and its page. The page is replaced whenever it is recycled."""
+
+    def __init__(self, name):
+        self.name = name
+        self.context = None
+        self.page = None
+        self.generation = None
+        self.pages = 0
+
+
+class BrowserManager:
+    """Owns the browser, leases tabs to crawl workers, and recycles tabs and the browser as they use up memory.
+
+    The browser is launched once per job with poolSize incognito contexts, each with a blank page
+    already open, so a worker only waits for one if they're all leased. Workers lease one with `lease()`,
+    load every page through `async with manager.page(tab) as page:` and hand it back with `release()`.
+
+    Between pages a tab is replaced after recycleTabAfter pages, when its JavaScript heap passes
+    maxTabHeap, or when a page fails. When the whole browser passes maxBrowserRSS it is restarted once every tab has finished its
+    current page; the crawl frontier lives with the workers, so nothing is lost.
+    """
+
+    def __init__(self, launchOptions, poolSize=1, recycleTabAfter=DEFAULT_RECYCLE_TAB_AFTER, maxTabHeap=DEFAULT_MAX_TAB_HEAP, maxBrowserRSS=DEFAULT_MAX_BROWSER_RSS):
+        self.launchOptions = launchOptions
+        self.poolSize = poolSize
+        self.pool = asyncio.Queue()
+        self.recycleTabAfter = recycleTabAfter
+        self.maxTabHeap = maxTabHeap * 1024 * 1024 if maxTabHeap else None
+        self.maxBrowserRSS = maxBrowserRSS * 1024 * 1024 if maxBrowserRSS else None
+        self.browser = None
+        self.generation = 0
+        self.inFlight = 0
+        self.restarting = False
+        self.condition = asyncio.Condition()
+
+    async def start(self):
+        """Launch the browser and pre-warm the pool of contexts."""
+        await self._launch()
+        with tracer.span('prewarm', category='browser'):
+            for i in range(self.poolSize):
+                tab = Tab('worker-' + str(i + 1))
+                await self._open(tab)
+                self.pool.put_nowait(tab)
+
+    async def _launch(self):
+        with tracer.span('launch', category='browser'):
+            self.browser = await launch(**self.launchOptions)
+
+    async def _open(self, tab):
+        """Give the tab a context in the running browser, if it doesn't have one, and a page in it."""
+        if tab.generation != self.generation or tab.context is None:
+            tab.context = await self.browser.createIncognitoBrowserContext()
+            tab.generation = self.generation
+            tab.page = None
+        if tab.page is None:
+            tab.page = await tab.context.newPage()
+            tab.pages = 0
+
+    async def lease(self, name):
+        """Wait for a free context and lease it to the worker called name."""
+        tab = await self.pool.get()
+        tab.name = name
+        return tab
+
+    async def release(self, tab):
+        """Take a leased context back, swapping it for a fresh one so the next worker starts without the last one's cookies and cache."""
+        if tab.context is not None and tab.generation == self.generation:
+            try:
+                await tab.context.close()
+            except Exception as e:
+                print(f"Warning: Error closing context of {tab.name}: {e}")
+        tab.context = None
+        tab.page = None
+        try:
+            if self.browser:
+                await self._open(tab)
+        except Exception as e:
+            # It's opened again when it's next used
+            print(f"Warning: Error pre-warming context: {e}")
+        self.pool.put_nowait(tab)
+
+    async def close(self):
+        """Close the browser, warning instead of raising if it's already gone."""
+        if not self.browser:
+            return
+        try:
+            await self.browser.close()
+            # Give pyppeteer time to clean up
+            await asyncio.sleep(0.1)
+        except Exception as e:
+            print(f"Warning: Error closing browser: {e}")
+        self.browser = None
+
+    async def close_tab(self, tab):
+        """Close the page behind a tab, if it belongs to the running browser."""
+        page, tab.page = tab.page, None
+        if page is None or tab.generation != self.generation:
+            return
+        try:
+            await page.close()
+        except Exception as e:
+            print(f"Warning: Error closing tab {tab.name}: {e}")
+
+    @asynccontextmanager
+    async def page(self, tab):
+        """Lend the tab's page for loading one URL, replacing it first if it was recycled or the browser restarted."""
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.restarting)
+            self.inFlight += 1
+
+        failed = False
+        try:
+            await self._open(tab)
+            yield tab.page
+        except Exception:
+            failed = True
+            raise
+        finally:
+            tab.pages += 1
+            async with self.condition:
+                self.inFlight -= 1
+                self.condition.notify_all()
+            await self._check(tab, failed)
+
+    async def _check(self, tab, failed):
+        """Recycle the tab or restart the browser if either has grown too big."""
+        if tab.page is not None and tab.generation == self.generation:
+            reason = None
+            if failed:
+                # A crashed or hung renderer isn't worth reusing
+                reason = 'page failed'
+            elif self.recycleTabAfter and tab.pages >= self.recycleTabAfter:
+                reason = f'{tab.pages} pages'
+            elif self.maxTabHeap:
+                try:
+                    heap = (await tab.page.metrics()).get('JSHeapUsedSize', 0)
+                except Exception:
+                    heap = 0
+                if heap > self.maxTabHeap:
+                    reason = f'{heap / 1024 / 1024:.0f} MB heap'
+            if reason:
+                print(f"Recycling tab {tab.name} ({reason})")
+                tracer.count('tab_recycles')
+                await self.close_tab(tab)
+
+        if self.maxBrowserRSS and self.browser and self.browser.process:
+            rss = process_tree_rss(self.browser.process.pid)
+            if rss is not None:
+                metrics.set('browser_rss_bytes', rss)
+                if rss > self.maxBrowserRSS:
+                    await self.restart(f'{rss / 1024 / 1024:.0f} MB resident')
+
+    async def restart(self, reason):
+        """Wait for every tab to finish its current page, then relaunch the browser."""
+        generation = self.generation
+        async with self.condition:
+            if self.restarting or self.generation != generation:
+                # Another worker is already restarting it
+                return
+            self.restarting = True
+            await self.condition.wait_for(lambda: self.inFlight == 0)
+
+        try:
+            print(f"Restarting browser ({reason})")
+            tracer.count('browser_restarts')
+            with tracer.span('restart', category='browser'):
+                await self.close()
+                # Contexts from the old browser are replaced as their workers next use them
+                await self._launch()
+            self.generation += 1
+        finally:
+            async with self.condition:
+                self.restarting = False
+                self.condition.notify_all()
@@ -0,0 +1,272 @@
+"""Output finalization for an exported site: content-hashed asset filenames, immutable cache headers and a service worker.
+
+Runs once every page of a site is saved. Each file under /images/, /fonts/ and /media/ that a page
+references is renamed to name.<hash>.ext and every reference in the pages (and any CSS files) is
+rewritten, so those URLs can be cached forever. A _headers file (Netlify, Cloudflare Pages) and an
+nginx snippet set the matching Cache-Control headers. Optionally a service worker precaches the
+pages and the assets they share, for near-instant repeat visits that also work offline.
+"""
+import os
+import re
+import json
+import hashlib
+from utils import hash_file, page_url
+
+
+# Folders whose files get fingerprinted
+ASSET_FOLDERS = ('images', 'fonts', 'media')
+# Length of the content hash added to asset filenames
+FINGERPRINT_LENGTH = 10
+
+# A root-relative reference to a local asset in HTML or CSS: right after a quote, bracket, space, comma,
+# equals sign or entity (url(&quot;...)), so the same path on another host (https://cdn.example/images/...)
+# is left alone. It runs up to the first quote, space, comma, bracket, query or entity.
+ASSET_REFERENCE = re.compile(r'(?<=["\'(\s,=;])/(' + '|'.join(ASSET_FOLDERS) + r')/([^"\'\s,()?#&<>]+)')
+# A filename fingerprinted by an earlier run
+FINGERPRINTED_NAME = re.compile(r'\.[0-9a-f]{' + str(FINGERPRINT_LENGTH) + r'}\.[^.]+$')
+
+# Fingerprinted names given by earlier runs, per absolute output folder
+_manifests = {}
+
+# One year, the longest lifetime browsers honour
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'public, max-age=0, must-revalidate'
+
+SERVICE_WORKER_REGISTRATION = '''<script>
+if ('serviceWorker' in navigator) {
+    window.addEventListener('load', () => navigator.serviceWorker.register('/sw.js'));
+}
+</script></body>'''
+
+# Pages are fetched from the network first so edits show up, falling back to the cache offline.
+# Fingerprinted assets never change, so they are served from the cache first.
+SERVICE_WORKER = '''const CACHE = 'wixscraper-%(version)s';
+const PRECACHE = %(precache)s;
+const FINGERPRINTED = /\\/(images|fonts|media)\\/.+\\.[0-9a-f]{%(length)d}\\.[^./]+$/;
+
+self.addEventListener('install', event => {
+    event.waitUntil(caches.open(CACHE).then(cache => cache.addAll(PRECACHE)).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(caches.keys()
+        .then(keys => Promise.all(keys.filter(key => key.startsWith('wixscraper-') && key !== CACHE).map(key => caches.delete(key))))
+        .then(() => self.clients.claim()));
+});
+
+self.addEventListener('fetch', event => {
+    const url = new URL(event.request.url);
+    if (event.request.method !== 'GET' || url.origin !== location.origin) {
+        return;
+    }
+
+    if (event.request.mode === 'navigate') {
+        event.respondWith(fetch(event.request)
+            .then(response => {
+                const copy = response.clone();
+                caches.open(CACHE).then(cache => cache.put(event.request, copy));
+                return response;
+            })
+            .catch(() => caches.match(event.request)
+                .then(response => response || caches.match(url.pathname.replace(/\\/?$/, '/'))))
+        );
+        return;
+    }
+
+    if (FINGERPRINTED.test(url.pathname)) {
+        event.respondWith(caches.match(event.request).then(cached => cached || fetch(event.request).then(response => {
+            const copy = response.clone();
+            caches.open(CACHE).then(cache => cache.put(event.request, copy));
+            return response;
+        })));
+    }
+});
+'''
+
+
+def site_files(outputDir, extensions):
+    """Return the paths of every file under outputDir with one of the extensions."""
+    paths = []
+    for folder, _, filenames in os.walk(outputDir):
+        for filename in filenames:
+            if filename.endswith(extensions):
+                paths.append(os.path.join(folder, filename))
+    return sorted(paths)
+
+
+def load_manifest(outputDir):
+    """Return {asset URL: fingerprinted URL} for the assets fingerprinted by earlier runs, from <outputDir>.fingerprints.json."""
+    key = os.path.abspath(outputDir)
+    if key not in _manifests:
+        try:
+            with open(outputDir + '.fingerprints.json', encoding='utf-8') as f:
+                _manifests[key] = json.load(f)
+        except (OSError, ValueError):
+            _manifests[key] = {}
+    return _manifests[key]
+
+
+def fingerprinted_url(outputDir, url):
+    """Return the URL an earlier run fingerprinted an asset (e.g. /images/hero.webp) to, if that file is still there."""
+    fingerprinted = load_manifest(outputDir).get(url)
+    return fingerprinted if fingerprinted and os.path.isfile(outputDir + fingerprinted) else None
+
+
+def asset_exists(outputDir, url):
+    """Return whether an asset is in the site, under its own name or the fingerprinted one an earlier run gave it.
+
+    Used instead of a plain os.path.exists by the steps that skip files written on an earlier run.
+    """
+    return os.path.isfile(outputDir + url) or fingerprinted_url(outputDir, url) is not None
+
+
+def fingerprint_assets(outputDir, documents):
+    """Rename every referenced asset to name.<hash>.ext and rewrite the references in documents ({path: text}).
+
+    An asset an earlier run already renamed, and this run didn't write again, keeps that name. Returns the
+    set of fingerprinted asset URLs.
+    """
+    manifest = load_manifest(outputDir)
+    referenced = set()
+    for text in documents.values():
+        for folder, name in ASSET_REFERENCE.findall(text):
+            if asset_exists(outputDir, '/' + folder + '/' + name):
+                referenced.add((folder, name))
+
+    renames = {}
+    for folder, name in sorted(referenced):
+        if FINGERPRINTED_NAME.search(name):
+            # Already fingerprinted by an earlier run
+            renames[(folder, name)] = name
+            continue
+        if not os.path.isfile(outputDir + '/' + folder + '/' + name):
+            # Skipped this run, as an earlier run wrote and fingerprinted it
+            renames[(folder, name)] = fingerprinted_url(outputDir, '/' + folder + '/' + name).rsplit('/', 1)[-1]
+            continue
+        digest = hash_file(outputDir + '/' + folder + '/' + name, 'sha256')[:FINGERPRINT_LENGTH]
+        stem, dot, ext = name.rpartition('.')
+        newName = stem + '.' + digest + dot + ext if dot else name + '.' + digest
+        os.replace(outputDir + '/' + folder + '/' + name, outputDir + '/' + folder + '/' + newName)
+        renames[(folder, name)] = newName
+        manifest['/' + folder + '/' + name] = '/' + folder + '/' + newName
+
+    def rewrite(match):
+        newName = renames.get((match.group(1), match.group(2)))
+        return '/' + match.group(1) + '/' + newName if newName else match.group(0)
+
+    for path in documents:
+        documents[path] = ASSET_REFERENCE.sub(rewrite, documents[path])
+
+    # Drop every other file in the asset folders: fingerprinted files of earlier runs no page uses any more,
+    # and unhashed files no page refers to. Only fingerprinted files are left, so the folders can be cached whole.
+    current = set((folder, name) for (folder, _), name in renames.items())
+    removed = 0
+    for folder in ASSET_FOLDERS:
+        if not os.path.isdir(outputDir + '/' + folder):
+            continue
+        for name in os.listdir(outputDir + '/' + folder):
+            if (folder, name) not in current and os.path.isfile(outputDir + '/' + folder + '/' + name):
+                os.remove(outputDir + '/' + folder + '/' + name)
+                removed += 1
+    if removed:
+        print(f"Removed {removed} assets no page uses")
+
+    # Remember the names given, so the next run skips what it would write again only to rename it
+    kept = set('/' + folder + '/' + name for folder, name in current)
+    for url in [url for url, fingerprinted in manifest.items() if fingerprinted not in kept]:
+        del manifest[url]
+    with open(outputDir + '.fingerprints.json', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return set('/' + folder + '/' + name for folder, name in current)
+
+
+def write_headers(outputDir, hostname):
+    """Write a _headers file into the site and an <outputDir>.nginx.conf snippet next to it.
+
+    Both mark the fingerprinted assets immutable and make the pages revalidate. fingerprint_assets leaves
+    only fingerprinted files in the asset folders, so _headers gets one rule per folder, well within
+    Cloudflare Pages' limit of 100 rules. Pages get no rule there: Netlify and Cloudflare Pages already
+    make HTML revalidate, and a catch-all rule would be joined onto the assets' own.
+    """
+    rules = []
+    for folder in ASSET_FOLDERS:
+        if os.path.isdir(outputDir + '/' + folder):
+            rules.append('/' + folder + '/*\n  Cache-Control: ' + IMMUTABLE_CACHE_CONTROL)
+    rules.append('/sw.js\n  Cache-Control: no-cache')
+    with open(outputDir + '/_headers', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(rules) + '\n')
+
+    nginx = '''# Cache headers for the exported %(hostname)s, include inside its server block
+location ~* "^/(%(folders)s)/.+\\.[0-9a-f]{%(length)d}\\.[^./]+$" {
+    add_header Cache-Control "%(immutable)s";
+    try_files $uri =404;
+}
+
+location = /sw.js {
+    add_header Cache-Control "no-cache";
+}
+
+location ~* \\.html$ {
+    add_header Cache-Control "%(revalidate)s";
+}
+
+# Folders are served through their index.html, and so through the location above
+location / {
+    index index.html;
+    try_files $uri $uri/ =404;
+}
+''' % {'hostname': hostname, 'folders': '|'.join(ASSET_FOLDERS), 'length': FINGERPRINT_LENGTH,
+       'immutable': IMMUTABLE_CACHE_CONTROL, 'revalidate': REVALIDATE_CACHE_CONTROL}
+    with open(outputDir + '.nginx.conf', 'w', encoding='utf-8') as f:
+        f.write(nginx)
+
+
+def write_service_worker(outputDir, pages, assets):
+    """Write sw.js, precaching the pages and the images and fonts used by more than one page (and every font)."""
+    uses = {}
+    for html in pages.values():
+        for folder, name in set(ASSET_REFERENCE.findall(html)):
+            uses['/' + folder + '/' + name] = uses.get('/' + folder + '/' + name, 0) + 1
+    # Media is left to the runtime cache, videos are too big to fetch up front
+    shared = sorted(url for url in assets if (uses.get(url, 0) > 1 or url.startswith('/fonts/')) and not url.startswith('/media/'))
+    precache = sorted(page_url(outputDir, path) for path in pages) + shared
+
+    # A new version whenever the precached files change, so old caches are dropped
+    version = hashlib.sha256(json.dumps(precache).encode()).hexdigest()[:FINGERPRINT_LENGTH]
+    with open(outputDir + '/sw.js', 'w', encoding='utf-8') as f:
+        f.write(SERVICE_WORKER % {'version': version, 'precache': json.dumps(precache, indent=4), 'length': FINGERPRINT_LENGTH})
+    print(f"Service worker precaches {len(precache)} files")
+
+
+def finalize_site(hostname, serviceWorker=False, outputDir=None):
+    """Fingerprint the assets of the exported site, write its cache headers and, if asked, its service worker.
+
+    The site is read from outputDir, the folder named after the hostname by default.
+    """
+    outputDir = outputDir or hostname
+    pages = {}
+    for path in site_files(outputDir, ('.html',)):
+        with open(path, encoding='utf-8') as f:
+            pages[path] = f.read()
+    stylesheets = {}
+    for path in site_files(outputDir, ('.css',)):
+        with open(path, encoding='utf-8') as f:
+            stylesheets[path] = f.read()
+
+    documents = dict(pages)
+    documents.update(stylesheets)
+    assets = fingerprint_assets(outputDir, documents)
+    print(f"Fingerprinted {len(assets)} assets")
+
+    for path, text in documents.items():
+        if serviceWorker and path in pages and 'navigator.serviceWorker.register' not in text:
+            text = text.replace('</body>', SERVICE_WORKER_REGISTRATION, 1)
+        if path in pages:
+            pages[path] = text
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    write_headers(outputDir, hostname)
+    if serviceWorker:
+        write_service_worker(outputDir, pages, assets)
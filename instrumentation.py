@@ -0,0 +1,114 @@
+"""Timing instrumentation for Wix Scraper: spans per page and stage, counters, and a Chrome trace export."""
+import os
+import json
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+# Trace events kept for the export, the oldest are dropped past this so long crawls use bounded memory
+DEFAULT_MAX_TRACE_EVENTS = 200000
+
+
+class Tracer:
+    """Records timed spans and counters, viewable in chrome://tracing or Perfetto.
+
+    Only the latest maxEvents events are kept for the trace export. The stage totals and counters
+    cover the whole run.
+    """
+
+    def __init__(self, maxEvents=DEFAULT_MAX_TRACE_EVENTS):
+        self.origin = time.perf_counter()
+        self.events = deque(maxlen=maxEvents)
+        self.dropped = 0
+        self.totals = {}
+        self.counters = {}
+        self.lanes = {}
+        self.lock = threading.Lock()
+
+    def configure(self, maxEvents=DEFAULT_MAX_TRACE_EVENTS):
+        """Set how many events are kept, from maxTraceEvents in config.json."""
+        with self.lock:
+            self.events = deque(self.events, maxlen=maxEvents)
+
+    def _record(self, event):
+        # Called with the lock held
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append(event)
+
+    def _lane(self):
+        """Return the trace row for the current asyncio task, or the current thread outside of one."""
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is not None:
+            key = ('task', id(task))
+            name = task.get_name()
+        else:
+            key = ('thread', threading.get_ident())
+            name = threading.current_thread().name
+        with self.lock:
+            if key not in self.lanes:
+                self.lanes[key] = (len(self.lanes) + 1, name)
+            return self.lanes[key][0]
+
+    def _now(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    @contextmanager
+    def span(self, name, category='stage', **args):
+        """Time the enclosed block as a span called name."""
+        lane = self._lane()
+        start = self._now()
+        try:
+            yield
+        finally:
+            event = {'name': name, 'cat': category, 'ph': 'X', 'ts': start, 'dur': self._now() - start, 'pid': os.getpid(), 'tid': lane, 'args': args}
+            seconds = event['dur'] / 1e6
+            with self.lock:
+                self._record(event)
+                count, total, longest = self.totals.get(name, (0, 0.0, 0.0))
+                self.totals[name] = (count + 1, total + seconds, max(longest, seconds))
+
+    def count(self, name, value=1):
+        """Add value to the counter called name."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self._record({'name': name, 'ph': 'C', 'ts': self._now(), 'pid': os.getpid(), 'args': {name: self.counters[name]}})
+
+    def export_chrome_trace(self, path):
+        """Write the kept spans and counters as Chrome trace event JSON."""
+        with self.lock:
+            events = list(self.events)
+            lanes = list(self.lanes.values())
+            dropped = self.dropped
+        if dropped:
+            print(f"Warning: The trace only holds the last {len(events)} events, {dropped} earlier ones were dropped")
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': lane, 'args': {'name': name}} for lane, name in lanes]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, f)
+
+    def stage_totals(self):
+        """Return {span name: (count, total seconds, max seconds)}."""
+        with self.lock:
+            return dict(self.totals)
+
+    def summary(self):
+        """Return a table of the time spent per span name, slowest first, followed by the counters."""
+        totals = self.stage_totals()
+        lines = ['{:<20} {:>7} {:>10} {:>10} {:>10}'.format('stage', 'count', 'total s', 'mean ms', 'max ms')]
+        for name, (count, total, longest) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            lines.append('{:<20} {:>7} {:>10.2f} {:>10.1f} {:>10.1f}'.format(name, count, total, total / count * 1000, longest * 1000))
+        with self.lock:
+            counters = dict(self.counters)
+        for name, value in sorted(counters.items()):
+            lines.append('{:<20} {:>7}'.format(name, value))
+        return '\n'.join(lines)
+
+
+# The tracer every module records into
+tracer = Tracer()
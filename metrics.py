@@ -0,0 +1,105 @@
+"""Live crawl metrics for Wix Scraper: a Prometheus endpoint or textfile, and a console progress line."""
+import os
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# name: (type, help). Counters only go up, gauges are set to the current value.
+METRICS = {
+    'pages_done': ('counter', 'Pages scraped and saved.'),
+    'pages_queued': ('gauge', 'Pages found but not scraped yet.'),
+    'pages_in_flight': ('gauge', 'Pages being scraped right now.'),
+    'errors': ('counter', 'Pages that failed to scrape.'),
+    'retries': ('counter', 'Failed pages queued for another attempt.'),
+    'throttled': ('counter', 'Requests answered with 429 or 5xx, or that failed to connect, by host.'),
+    'bytes_fetched': ('counter', 'Bytes downloaded for images, fonts and media.'),
+    'encode_queue_depth': ('gauge', 'Images waiting to be downloaded and encoded.'),
+    'browser_rss_bytes': ('gauge', 'Resident memory of the browser and all its processes.'),
+}
+
+
+class CrawlMetrics:
+    """Counters and gauges of a crawl, labelled by site."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, site=''):
+        """Add value to a counter (or gauge)."""
+        with self.lock:
+            self.values[(name, site)] = self.values.get((name, site), 0) + value
+
+    def set(self, name, value, site=''):
+        """Set a gauge."""
+        with self.lock:
+            self.values[(name, site)] = value
+
+    def total(self, name):
+        """Return the value of a metric summed over all sites."""
+        with self.lock:
+            return sum(value for (metric, _), value in self.values.items() if metric == name)
+
+    def render_prometheus(self):
+        """Return every metric in the Prometheus text exposition format."""
+        with self.lock:
+            values = dict(self.values)
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            metric = 'wixscraper_' + name + ('_total' if kind == 'counter' else '')
+            lines.append('# HELP ' + metric + ' ' + description)
+            lines.append('# TYPE ' + metric + ' ' + kind)
+            samples = [(site, value) for (key, site), value in sorted(values.items()) if key == name] or [('', 0)]
+            for site, value in samples:
+                labels = '{site="' + site + '"}' if site else ''
+                lines.append(metric + labels + ' ' + str(value))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """Write the metrics for node_exporter's textfile collector, atomically."""
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(self.render_prometheus())
+        os.replace(path + '.tmp', path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve the metrics at http://<host>:<port>/metrics from a background thread.
+
+        Only reachable from this machine unless another host (e.g. 0.0.0.0) is given.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Metrics served at http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+    def progress_line(self):
+        """Return a one-line summary of the crawl's progress, speed and ETA."""
+        done = self.total('pages_done')
+        queued = self.total('pages_queued')
+        elapsed = time.time() - self.start
+        rate = done / elapsed * 60 if elapsed else 0
+        line = f"[{done}/{done + queued} pages] {rate:.1f} pages/min, {self.total('pages_in_flight')} in flight, "
+        line += f"{self.total('errors')} errors, {self.total('retries')} retries, {self.total('bytes_fetched') / 1024 / 1024:.1f} MB"
+        if done and queued:
+            eta = int(queued / (done / elapsed))
+            line += f", ETA {eta // 3600}h{eta % 3600 // 60:02d}m{eta % 60:02d}s"
+        return line
+
+
+# The metrics every module reports into
+metrics = CrawlMetrics()
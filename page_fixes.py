@@ -1,7 +1,17 @@
 """Page manipulation functions for fixing Wix pages."""
 import asyncio
 from utils import scroll_to_bottom
-from asset_handlers import makeLocalImages, makeFontsLocal
+from instrumentation import tracer
+from asset_handlers import makeLocalImages, makeFontsLocal, makeMediaLocal, fontMimeType, DEFAULT_CACHE_DIR
+
+
+# Open-source libraries replacing the Wix gallery, slideshow and map
+JQUERY_URL = 'https://cdn.jsdelivr.net/npm/jquery@3.6.4/dist/jquery.min.js'
+SLICK_CSS_URL = 'https://cdnjs.cloudflare.com/ajax/libs/slick-carousel/1.9.0/slick.css'
+SLICK_THEME_CSS_URL = 'https://cdnjs.cloudflare.com/ajax/libs/slick-carousel/1.9.0/slick-theme.css'
+SLICK_JS_URL = 'https://cdnjs.cloudflare.com/ajax/libs/slick-carousel/1.9.0/slick.min.js'
+LEAFLET_CSS_URL = 'https://cdnjs.cloudflare.com/ajax/libs/leaflet/1.9.3/leaflet.css'
+LEAFLET_JS_URL = 'https://cdnjs.cloudflare.com/ajax/libs/leaflet/1.9.3/leaflet.js'
 
 
 # Only use this function in compliance with Wix Terms of Service. 
@@ -67,10 +77,10 @@ async def fix_gallery(page):
         print("Found gallery! Fixing..")
         
         # Import slick.carousel
-        await page.addScriptTag(url='https://cdn.jsdelivr.net/npm/jquery@3.6.4/dist/jquery.min.js')
-        await page.addStyleTag(url='https://cdnjs.cloudflare.com/ajax/libs/slick-carousel/1.9.0/slick.css')
-        await page.addStyleTag(url='https://cdnjs.cloudflare.com/ajax/libs/slick-carousel/1.9.0/slick-theme.css')
-        await page.addScriptTag(url='https://cdnjs.cloudflare.com/ajax/libs/slick-carousel/1.9.0/slick.min.js')
+        await page.addScriptTag(url=JQUERY_URL)
+        await page.addStyleTag(url=SLICK_CSS_URL)
+        await page.addStyleTag(url=SLICK_THEME_CSS_URL)
+        await page.addScriptTag(url=SLICK_JS_URL)
 
         # Get all img links
         img_links = await gallery.querySelectorAllEval('img', 'nodes => nodes.map(n => n.src)')
@@ -142,16 +152,16 @@ async def fix_googlemap(page, mapData):
         print("Found Google Maps! Fixing..")
 
         # Import leaflet
-        await page.addStyleTag(url='https://cdnjs.cloudflare.com/ajax/libs/leaflet/1.9.3/leaflet.css')
+        await page.addStyleTag(url=LEAFLET_CSS_URL)
 
-        await page.evaluate('''() => {
+        await page.evaluate('''(url) => {
             const script = document.querySelector('script');
             if (script && script.parentNode) {
                 const element = document.createElement('script');
-                element.src = 'https://cdnjs.cloudflare.com/ajax/libs/leaflet/1.9.3/leaflet.js';
+                element.src = url;
                 script.parentNode.insertBefore(element, script.nextSibling);
             }
-        }''')
+        }''', LEAFLET_JS_URL)
 
         # Add new style tag to the page
         await page.addStyleTag(content='''
@@ -246,10 +256,10 @@ async def fix_slideshow(page):
         print("Found Slideshow! Fixing..")
         
         # Import slick.carousel
-        await page.addScriptTag(url='https://cdn.jsdelivr.net/npm/jquery@3.6.4/dist/jquery.min.js')
-        await page.addStyleTag(url='https://cdnjs.cloudflare.com/ajax/libs/slick-carousel/1.9.0/slick.css')
-        await page.addStyleTag(url='https://cdnjs.cloudflare.com/ajax/libs/slick-carousel/1.9.0/slick-theme.css')
-        await page.addScriptTag(url='https://cdnjs.cloudflare.com/ajax/libs/slick-carousel/1.9.0/slick.min.js')
+        await page.addScriptTag(url=JQUERY_URL)
+        await page.addStyleTag(url=SLICK_CSS_URL)
+        await page.addStyleTag(url=SLICK_THEME_CSS_URL)
+        await page.addScriptTag(url=SLICK_JS_URL)
 
         # Create the carousel and insert it two parents above the gallery
         await page.evaluate('''() => {
@@ -335,107 +345,41 @@ async def fix_slideshow(page):
         }''')
 
 
-# Constants for HTML fixes
-slideFix = '''<script>
-        window.addEventListener('DOMContentLoaded', function() {
-        var $jq = jQuery.noConflict();
-        $jq(document).ready(function () {
-            $jq('.slick-carousel-slides').slick({
-                dots: true,
-                infinite: false,
-                speed: 300,
-                slidesToShow: 1,
-                responsive: [
-                    {
-                    breakpoint: 1024,
-                    settings: {
-                        slidesToShow: 1,
-                    }
-                    },
-                    {
-                    breakpoint: 600,
-                    settings: {
-                        slidesToShow: 1,
-                    }
-                    }
-                ]
-            });
-        });
-    });</script></body>'''
-
-lightModeFix = '''<style>
-        .slick-dots li button:before {
-            font-family: 'slick';
-            font-size: 6px;
-            line-height: 20px;
-            position: absolute;
-            top: 0;
-            left: 0;
-            width: 20px;
-            height: 20px;
-            content: '•';
-            text-align: center;
-            opacity: .25;
-            color: white;
-            -webkit-font-smoothing: antialiased;
-            -moz-osx-font-smoothing: grayscale;
-        }
-
-        .slick-dots li.slick-active button:before {
-            opacity: .75;
-            color: white;
-        }
-    </style></head>'''
-
+async def add_preload_hints(page, lcpImage, criticalFonts, preloadBudget):
+    """Preload the LCP image and the fonts used above the fold, up to preloadBudget hints."""
+    preloads = []
 
-async def fix_page(page, wait, hostname, blockPrimaryFolder, darkWebsite, forceDownloadAgain, metatags, mapData):
-    """Main function to fix a Wix page - applies all transformations."""
-    # Get the current page
-    key = page.url.split(hostname)[1]
+    # The LCP image comes first, in the best format offered for it
+    if lcpImage and preloadBudget > 0:
+        attributes = {'rel': 'preload', 'as': 'image', 'fetchpriority': 'high'}
+        if lcpImage['sources']:
+            source = lcpImage['sources'][0]
+            attributes.update({'type': source['type'], 'imagesrcset': source['srcset'], 'imagesizes': source['sizes']})
+        elif 'srcset' in lcpImage['attributes']:
+            attributes.update({'imagesrcset': lcpImage['attributes']['srcset'], 'imagesizes': lcpImage['attributes']['sizes']})
+        else:
+            attributes['href'] = lcpImage['attributes']['src']
+        preloads.append(attributes)
 
-    print("Current page: " + key)
-    
-    await asyncio.sleep(wait)
-    await scroll_to_bottom(page)
-    await delete_wix(page)
-    await fix_gallery(page)
-    await fix_googlemap(page, mapData)
-    await fix_slideshow(page)
-
-    # Defer all scripts
-    await page.evaluate('''() => {
-        const elements = document.querySelectorAll('script');
-        for (const element of elements) {
-            element.setAttribute('defer', '');
-        }
-    }''')
+    for font in criticalFonts[:preloadBudget - len(preloads)]:
+        # href goes right after rel, optimizeFonts rewrites these links by matching that order
+        preloads.append({'rel': 'preload', 'href': font, 'as': 'font', 'type': fontMimeType(font), 'crossorigin': ''})
 
-    # In every font-face, add font-display: swap;
-    await page.evaluate('''() => {
-        const elements = document.querySelectorAll('style');
-        for (const element of elements) {
-            if (element.innerText.includes('@font-face')) {
-                element.innerText = element.innerText.replace('@font-face {', '@font-face { font-display: swap;');
+    # Insert at the start of the head so they are discovered before any CSS
+    await page.evaluate('''(preloads) => {
+        const head = document.querySelector('head');
+        for (const attributes of preloads.reverse()) {
+            const element = document.createElement('link');
+            for (const name in attributes) {
+                element.setAttribute(name, attributes[name]);
             }
+            head.insertBefore(element, head.firstChild);
         }
-    }''')
-
-    # Remove data-href from every style tag
-    await page.evaluate('''() => {
-        const elements = document.querySelectorAll('style');
-        for (const element of elements) {
-            element.removeAttribute('data-href');
-            element.removeAttribute('data-url');
-        }
-    }''')
+    }''', preloads)
 
-    # Make all images local
-    await makeLocalImages(page, hostname, forceDownloadAgain)
-
-    # Make all fonts local
-    await makeFontsLocal(page, hostname, forceDownloadAgain)
 
-    # Meta fixes
+async def fix_meta(page, hostname, key, metatags):
+    """Replace the page's meta tags with the title, SEO, social and favicon tags from metatags."""
     # Delete all meta tags
     await page.evaluate('''() => {
         const elements = document.querySelectorAll('meta');
@@ -639,37 +583,166 @@ async def fix_page(page, wait, hostname, blockPrimaryFolder, darkWebsite, forceD
         document.querySelector('head').appendChild(element);
     }''')
 
+
+# Constants for HTML fixes
+slideFix = '''<script>
+        window.addEventListener('DOMContentLoaded', function() {
+        var $jq = jQuery.noConflict();
+        $jq(document).ready(function () {
+            $jq('.slick-carousel-slides').slick({
+                dots: true,
+                infinite: false,
+                speed: 300,
+                slidesToShow: 1,
+                responsive: [
+                    {
+                    breakpoint: 1024,
+                    settings: {
+                        slidesToShow: 1,
+                    }
+                    },
+                    {
+                    breakpoint: 600,
+                    settings: {
+                        slidesToShow: 1,
+                    }
+                    }
+                ]
+            });
+        });
+    });</script></body>'''
+
+lightModeFix = '''<style>
+        .slick-dots li button:before {
+            font-family: 'slick';
+            font-size: 6px;
+            line-height: 20px;
+            position: absolute;
+            top: 0;
+            left: 0;
+            width: 20px;
+            height: 20px;
+            content: '•';
+            text-align: center;
+            opacity: .25;
+            color: white;
+            -webkit-font-smoothing: antialiased;
+            -moz-osx-font-smoothing: grayscale;
+        }
+
+        .slick-dots li.slick-active button:before {
+            opacity: .75;
+            color: white;
+        }
+    </style></head>'''
+
+
+async def fix_page(page, wait, hostname, blockPrimaryFolder, darkWebsite, forceDownloadAgain, metatags, mapData, imageOptions=None, fontUsage=None, preloadBudget=3, maxDownloadSize=None, outputDir=None):
+    """Main function to fix a Wix page - applies all transformations.
+
+    Its images, fonts and media are saved under outputDir, the folder named after the hostname by default.
+    """
+    # Get the current page
+    key = page.url.split(hostname)[1]
+
+    print("Current page: " + key)
+    
+    with tracer.span('wait', page=key):
+        await asyncio.sleep(wait)
+    with tracer.span('scroll', page=key):
+        await scroll_to_bottom(page)
+    with tracer.span('delete_wix', page=key):
+        await delete_wix(page)
+    with tracer.span('gallery', page=key):
+        await fix_gallery(page)
+    with tracer.span('map', page=key):
+        await fix_googlemap(page, mapData)
+    with tracer.span('slideshow', page=key):
+        await fix_slideshow(page)
+
+    with tracer.span('cleanup', page=key):
+        # Defer all scripts
+        await page.evaluate('''() => {
+            const elements = document.querySelectorAll('script');
+            for (const element of elements) {
+                element.setAttribute('defer', '');
+            }
+        }''')
+
+        # In every font-face, add font-display: swap;
+        await page.evaluate('''() => {
+            const elements = document.querySelectorAll('style');
+            for (const element of elements) {
+                if (element.innerText.includes('@font-face')) {
+                    element.innerText = element.innerText.replace('@font-face {', '@font-face { font-display: swap;');
+                }
+            }
+        }''')
+
+        # Remove data-href from every style tag
+        await page.evaluate('''() => {
+            const elements = document.querySelectorAll('style');
+            for (const element of elements) {
+                element.removeAttribute('data-href');
+                element.removeAttribute('data-url');
+            }
+        }''')
+
+    # Fonts and media are downloaded through the same cache as the images, shared by every site in a batch
+    cacheDir = (imageOptions or {}).get('cacheDir', DEFAULT_CACHE_DIR)
+
+    # Make all images local
+    with tracer.span('images', page=key):
+        lcpImage = await makeLocalImages(page, hostname, forceDownloadAgain, imageOptions, maxDownloadSize, outputDir)
+
+    # Make all fonts local
+    with tracer.span('fonts', page=key):
+        criticalFonts = await makeFontsLocal(page, hostname, forceDownloadAgain, fontUsage, maxDownloadSize, cacheDir, outputDir)
+
+    # Make all videos and documents local
+    with tracer.span('media', page=key):
+        await makeMediaLocal(page, hostname, forceDownloadAgain, maxDownloadSize, cacheDir, outputDir)
+
+    # Preload the LCP image and above-the-fold fonts
+    with tracer.span('preload', page=key):
+        await add_preload_hints(page, lcpImage, criticalFonts, preloadBudget)
+
+    # Meta fixes
+    with tracer.span('meta', page=key):
+        await fix_meta(page, hostname, key, metatags)
+
     # Get final HTML and apply fixes
-    html = await page.evaluate('document.documentElement.outerHTML')
+    with tracer.span('serialize', page=key):
+        html = await page.evaluate('document.documentElement.outerHTML')
 
-    html = html.replace('<br>', '')
-    html = html.replace('</body>', slideFix)
-    if(darkWebsite):
-        html = html.replace('</head>', lightModeFix)
+        html = html.replace('<br>', '')
+        html = html.replace('</body>', slideFix)
+        if(darkWebsite):
+            html = html.replace('</head>', lightModeFix)
     
-    # Fix every href to be relative 
-    html = html.replace('href="https://' + hostname, 'href="')
-    html = html.replace('href="http://' + hostname, 'href="')
-    html = html.replace('href="https://www.' + hostname, 'href="')
-    html = html.replace('href="http://www.' + hostname, 'href="')
-    html = html.replace('href="www.' + hostname, 'href="')
-    html = html.replace('href="' + hostname, 'href="')
-
-    # Remove the primaryFolder from any hrefs
-    html = html.replace('href="/' + blockPrimaryFolder, 'href="')
-
-    # Any empty hrefs are now root hrefs, replace them with /
-    html = html.replace('href=""', 'href="/"')
-
-    # Remove browser-sentry script
-    html = html.replace('<script src="https://browser.sentry-cdn.com/6.18.2/bundle.min.js" defer></script>', '')
-    html = html.replace('//static.parastorage.com', 'https://static.parastorage.com')
-
-    # Add passive listeners for better performance
-    html = html.replace('<script src="https://cdn.jsdelivr.net/npm/jquery@3.6.4/dist/jquery.min.js" defer=""></script>', 
-    '''<script src="https://cdn.jsdelivr.net/npm/jquery@3.6.4/dist/jquery.min.js" defer=""></script><script>window.addEventListener('DOMContentLoaded', function() { jQuery.event.special.touchstart = { setup: function( _, ns, handle ) { this.addEventListener("touchstart", handle, { passive: !ns.includes("noPreventDefault") }); } }; jQuery.event.special.touchmove = { setup: function( _, ns, handle ) { this.addEventListener("touchmove", handle, { passive: !ns.includes("noPreventDefault") }); } }; jQuery.event.special.wheel = { setup: function( _, ns, handle ){ this.addEventListener("wheel", handle, { passive: true }); } }; jQuery.event.special.mousewheel = { setup: function( _, ns, handle ){ this.addEventListener("mousewheel", handle, { passive: true }); } }; });</script>''')
-
-    # Add doctype HTML to start 
-    html = '<!DOCTYPE html>' + html
+        # Fix every href to be relative 
+        html = html.replace('href="https://' + hostname, 'href="')
+        html = html.replace('href="http://' + hostname, 'href="')
+        html = html.replace('href="https://www.' + hostname, 'href="')
+        html = html.replace('href="http://www.' + hostname, 'href="')
+        html = html.replace('href="www.' + hostname, 'href="')
+        html = html.replace('href="' + hostname, 'href="')
+
+        # Remove the primaryFolder from any hrefs
+        html = html.replace('href="/' + blockPrimaryFolder, 'href="')
+
+        # Any empty hrefs are now root hrefs, replace them with /
+        html = html.replace('href=""', 'href="/"')
+
+        # Remove browser-sentry script
+        html = html.replace('<script src="https://browser.sentry-cdn.com/6.18.2/bundle.min.js" defer></script>', '')
+        html = html.replace('//static.parastorage.com', 'https://static.parastorage.com')
+
+        # Add passive listeners for better performance
+        html = html.replace('<script src="' + JQUERY_URL + '" defer=""></script>', 
+        '<script src="' + JQUERY_URL + '" defer=""></script>' + '''<script>window.addEventListener('DOMContentLoaded', function() { jQuery.event.special.touchstart = { setup: function( _, ns, handle ) { this.addEventListener("touchstart", handle, { passive: !ns.includes("noPreventDefault") }); } }; jQuery.event.special.touchmove = { setup: function( _, ns, handle ) { this.addEventListener("touchmove", handle, { passive: !ns.includes("noPreventDefault") }); } }; jQuery.event.special.wheel = { setup: function( _, ns, handle ){ this.addEventListener("wheel", handle, { passive: true }); } }; jQuery.event.special.mousewheel = { setup: function( _, ns, handle ){ this.addEventListener("mousewheel", handle, { passive: true }); } }; });</script>''')
+
+        # Add doctype HTML to start 
+        html = '<!DOCTYPE html>' + html
 
     return html
@@ -0,0 +1,136 @@
+"""Per-host adaptive rate limiting and circuit breaking for Wix Scraper's page loads and downloads."""
+import time
+import random
+import asyncio
+import threading
+from urllib.parse import urlparse
+from metrics import metrics
+
+
+# Seconds between two requests to the same host: where every host starts, and the bounds of the adaptive pacing
+DEFAULT_MIN_INTERVAL = 0.0
+DEFAULT_MAX_INTERVAL = 10.0
+# Exponential backoff after a failure, in seconds: base * 2^(failures - 1), capped
+DEFAULT_BASE_BACKOFF = 1.0
+DEFAULT_MAX_BACKOFF = 60.0
+# Consecutive failures that open a host's circuit, and how long it stays open at first
+DEFAULT_MAX_FAILURES = 5
+DEFAULT_COOLDOWN = 60.0
+
+# Responses that mean the host is overloaded or throttling us
+THROTTLE_STATUSES = (429, 500, 502, 503, 504)
+# A response this many times slower than the host's average counts as a sign of load
+SLOW_FACTOR = 2.0
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request to a host whose circuit is open."""
+
+    def __init__(self, host, retryIn):
+        super().__init__(f"{host} is failing, paused for {retryIn:.0f}s")
+        self.host = host
+        self.retryIn = retryIn
+
+
+class HostState:
+    """Pacing and failure history of one host."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.nextSlot = 0.0
+        self.latency = None
+        self.failures = 0
+        self.openUntil = 0.0
+        self.cooldown = None
+
+
+class RateLimiter:
+    """Paces requests per host, slowing down on 429/5xx, errors and rising latency and speeding back up
+    on fast successes. After maxFailures failures in a row a host's circuit opens: requests to it raise
+    CircuitOpenError until the cooldown passes, then a single failure reopens it for twice as long.
+    """
+
+    def __init__(self):
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.configure()
+
+    def configure(self, minInterval=DEFAULT_MIN_INTERVAL, maxInterval=DEFAULT_MAX_INTERVAL, baseBackoff=DEFAULT_BASE_BACKOFF,
+                  maxBackoff=DEFAULT_MAX_BACKOFF, maxFailures=DEFAULT_MAX_FAILURES, cooldown=DEFAULT_COOLDOWN):
+        """Set the limits, from the rateLimit block of config.json."""
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.baseBackoff = baseBackoff
+        self.maxBackoff = maxBackoff
+        self.maxFailures = maxFailures
+        self.cooldown = cooldown
+
+    def _state(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = HostState(self.minInterval)
+        return self.hosts[host]
+
+    def reserve(self, url):
+        """Book the next request slot for the url's host and return how many seconds to wait for it."""
+        host = urlparse(url).hostname
+        with self.lock:
+            state = self._state(host)
+            now = time.monotonic()
+            if now < state.openUntil:
+                raise CircuitOpenError(host, state.openUntil - now)
+            slot = max(now, state.nextSlot)
+            state.nextSlot = slot + state.interval
+            return slot - now
+
+    def wait(self, url):
+        """Block until a request to the url's host may be sent."""
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire(self, url):
+        """Wait, without blocking the event loop, until a request to the url's host may be sent."""
+        delay = self.reserve(url)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def record(self, url, latency=None, status=None, error=False, retryAfter=None):
+        """Adjust the url's host's pacing from the outcome of a request to it."""
+        host = urlparse(url).hostname
+        with self.lock:
+            state = self._state(host)
+            now = time.monotonic()
+
+            if error or status in THROTTLE_STATUSES:
+                metrics.inc('throttled', site=host)
+                state.failures += 1
+                state.interval = min(self.maxInterval, max(state.interval * 2, 0.1))
+
+                # Back off exponentially, with full jitter so parallel workers don't retry in lockstep
+                backoff = random.uniform(0, min(self.maxBackoff, self.baseBackoff * 2 ** (state.failures - 1)))
+                if retryAfter:
+                    backoff = max(backoff, retryAfter)
+                state.nextSlot = max(state.nextSlot, now + backoff)
+
+                if state.failures >= self.maxFailures:
+                    # Half-open: the first request after a cooldown decides, failing again doubles it
+                    state.cooldown = min(state.cooldown * 2, self.maxBackoff * 10) if state.cooldown else self.cooldown
+                    state.openUntil = now + state.cooldown * random.uniform(1, 1.2)
+                    print(f"Warning: {host} failed {state.failures} times in a row, pausing it for {state.cooldown:.0f}s")
+                return
+
+            state.failures = 0
+            state.cooldown = None
+            if latency is not None:
+                slow = state.latency is not None and latency > state.latency * SLOW_FACTOR
+                state.latency = latency if state.latency is None else state.latency * 0.8 + latency * 0.2
+                if slow:
+                    state.interval = min(self.maxInterval, max(state.interval * 1.5, 0.1))
+                    return
+            # Speed back up gradually
+            state.interval = max(self.minInterval, state.interval * 0.9)
+            if state.interval < 0.01:
+                state.interval = self.minInterval
+
+
+limiter = RateLimiter()
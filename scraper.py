@@ -1,114 +1,347 @@
 """Main scraping logic for Wix Scraper."""
 import json
 import os
+import time
 import asyncio
 from urllib.parse import urlparse
-from pyppeteer import launch
 from page_fixes import fix_page
+from asset_handlers import optimizeFonts, MEDIA_EXTENSIONS
+from instrumentation import tracer, DEFAULT_MAX_TRACE_EVENTS
+from audit import run_audit
+from finalize import finalize_site
+from metrics import metrics
+from ratelimit import limiter, CircuitOpenError, THROTTLE_STATUSES
+from browser_manager import BrowserManager, find_browser, LEAN_BROWSER_ARGS, DEFAULT_RECYCLE_TAB_AFTER, DEFAULT_MAX_TAB_HEAP, DEFAULT_MAX_BROWSER_RSS
 
 
-async def main():
-    """Main function to scrape a Wix website."""
-    # Load the data from the json file
-    with open('config.json') as f:
-        data = json.load(f)
+# Sites crawled at the same time in batch mode, all sharing one browser
+DEFAULT_MAX_CONCURRENT_SITES = 4
+# Times in a row a site may be paused by an open circuit before it is given up on
+DEFAULT_MAX_CIRCUIT_WAITS = 5
 
-    site = data['site']
-    blockPrimaryFolder = data['blockPrimaryFolder']
-    wait = data['wait']
-    recursive = data['recursive'].lower() == 'true'
-    darkWebsite = data['darkWebsite'].lower() == 'true'
-    forceDownloadAgain = data['forceDownloadAgain'].lower() == 'true'
-    metatags = data['metatags']
-    mapData = data['mapData']
 
-    # Get the hostname
+async def load_page(page, url):
+    """Load url in the page, paced by the per-host rate limiter. Raises if the host throttled or failed the request."""
+    await limiter.acquire(url)
+    start = time.monotonic()
+    try:
+        response = await page.goto(url)
+    except Exception:
+        limiter.record(url, error=True)
+        raise
+    status = response.status if response else None
+    limiter.record(url, time.monotonic() - start, status)
+    if status in THROTTLE_STATUSES:
+        raise IOError(f"{url} returned HTTP {status}")
+    return response
+
+
+def site_config(data, siteData=None):
+    """Merge one entry of "sites" over the top-level config and parse it into the settings of one crawl."""
+    merged = {key: value for key, value in data.items() if key != 'sites'}
+    merged.update(siteData or {})
+
+    site = merged['site']
     hostname = urlparse(site).hostname
+    return {
+        'site': site,
+        'hostname': hostname,
+        # The folder the site is exported to, and its reports written next to
+        'outputDir': merged.get('outputDir', hostname),
+        'blockPrimaryFolder': merged['blockPrimaryFolder'],
+        'wait': merged['wait'],
+        'recursive': merged['recursive'].lower() == 'true',
+        'darkWebsite': merged['darkWebsite'].lower() == 'true',
+        'forceDownloadAgain': merged['forceDownloadAgain'].lower() == 'true',
+        'metatags': merged['metatags'],
+        'mapData': merged['mapData'],
+        'preloadBudget': merged.get('preloadBudget', 3),
+        'maxCircuitWaits': merged.get('maxCircuitWaits', DEFAULT_MAX_CIRCUIT_WAITS),
+        # Downloads larger than this many megabytes are skipped
+        'maxDownloadSize': merged.get('maxDownloadSize', 200) * 1024 * 1024,
+        'subsetFonts': merged.get('subsetFonts', 'True').lower() == 'true',
+        'fingerprintAssets': merged.get('fingerprintAssets', 'True').lower() == 'true',
+        'serviceWorker': merged.get('serviceWorker', 'False').lower() == 'true',
+        'imageOptions': {key: merged[key] for key in ('responsiveWidths', 'imageFormats', 'imageQualities', 'minImageQuality', 'cacheDir') if key in merged},
+        # Budgets the exported pages are audited against at the end, see audit.py
+        'budgets': merged.get('budgets'),
+    }
+
 
-    # Use microsoft edge as the browser, set width and height to 1920x1080
-    browser = None
+async def crawl_site(manager, config, report_progress):
+    """Crawl one site in a browser context leased from the pool and export it to its output folder.
+
+    Returns the summary of the crawl: pages saved, page errors and budget violations.
+    """
+    site = config['site']
+    hostname = config['hostname']
+    blockPrimaryFolder = config['blockPrimaryFolder']
+    wait = config['wait']
+    recursive = config['recursive']
+    darkWebsite = config['darkWebsite']
+    forceDownloadAgain = config['forceDownloadAgain']
+    metatags = config['metatags']
+    mapData = config['mapData']
+    preloadBudget = config['preloadBudget']
+    maxDownloadSize = config['maxDownloadSize']
+    imageOptions = config['imageOptions']
+    outputDir = config['outputDir']
+    summary = {'site': site, 'pages': 0, 'errors': 0, 'violations': 0}
+
+    # Characters rendered per font family across all pages, for subsetting the fonts at the end
+    fontUsage = {}
+
+    tab = await manager.lease(hostname)
     try:
-        browser = await launch(headless=False, defaultViewport=None, executablePath='C:\\Program Files (x86)\\Microsoft\\Edge\\Application\\msedge.exe', args=['--window-size=1920,1080'])
-        
-        page = await browser.newPage()
-        await page.goto(site)
-        
-        print(site)
+        async with manager.page(tab) as page:
+            with tracer.span('goto', category='page', url=site):
+                await load_page(page, site)
+
+            print(site)
 
-        # Fix the first page
-        html = await fix_page(page, wait, hostname, blockPrimaryFolder, darkWebsite, forceDownloadAgain, metatags, mapData)
+            # Fix the first page
+            metrics.set('pages_in_flight', 1, site=hostname)
+            with tracer.span('page', category='page', url=site):
+                html = await fix_page(page, wait, hostname, blockPrimaryFolder, darkWebsite, forceDownloadAgain, metatags, mapData, imageOptions, fontUsage, preloadBudget, maxDownloadSize, outputDir)
+            links = await page.querySelectorAllEval('a', 'nodes => nodes.map(n => n.href)')
 
-        if not os.path.exists(hostname):
-            os.mkdir(hostname)
+        if not os.path.exists(outputDir):
+            os.makedirs(outputDir)
 
-        with open(hostname + '/index.html', 'w', encoding="utf-8") as f:
+        with open(outputDir + '/index.html', 'w', encoding="utf-8") as f:
             f.write(html)
 
+        metrics.set('pages_in_flight', 0, site=hostname)
+        metrics.inc('pages_done', site=hostname)
+        report_progress()
+
+        summary['pages'] += 1
+
         if(recursive): 
             seen = []
-            # Recursively go through all the local links and save them to the directory
-            async def save_links(page, links):
+            # Every local link found so far, and the ones still to save. The frontier is kept here rather
+            # than in the tab, so recycling the tab or restarting the browser mid-crawl loses nothing.
+            discovered = set()
+            frontier = []
+            errors = {}
+            # Pauses for an open circuit since the last page saved
+            circuitWaits = 0
+
+            def enqueue(links):
                 # Delete all links that are not local
                 links = [link for link in links if hostname in link]
                 # Delete all links with hash
                 links = [link for link in links if '#' not in link]
-                links = set(links)
-                errors = {}
-                for link in links:
-                    print(link)
-                    if link in seen:
-                        continue
+                # Delete links to videos and documents, makeMediaLocal downloads those
+                links = [link for link in links if urlparse(link).path.rsplit('.', 1)[-1].lower() not in MEDIA_EXTENSIONS]
+                # Links found last are saved first, so the site is still crawled depth first
+                for link in set(links).difference(discovered):
+                    discovered.add(link)
+                    frontier.append(link)
+                metrics.set('pages_queued', len(frontier), site=hostname)
+
+            enqueue(links)
+            while frontier:
+                link = frontier.pop()
+                metrics.set('pages_queued', len(frontier), site=hostname)
+                print(link)
+                if link in seen:
+                    continue
+
+                try:
+                    metrics.set('pages_in_flight', 1, site=hostname)
+                    async with manager.page(tab) as page:
+                        with tracer.span('goto', category='page', url=link):
+                            await load_page(page, link)
 
-                    try:
-                        await page.goto(link)
-                        
                         seen.append(link)
 
-                        html = await fix_page(page, wait, hostname, blockPrimaryFolder, darkWebsite, forceDownloadAgain, metatags, mapData)
-
-                        # Write each page as index.html to a folder named after the page
-                        # Check if the hostname is nested inside another folder
-                        # Count number of slashes
-                        newlink = link.replace('https://', '').replace('http://', '')
-
-                        if(newlink.count('/') > 1 and blockPrimaryFolder not in newlink.split('/')[1]):
-                            # Create the folder
-                            if not os.path.exists(hostname + '/' + '/'.join(newlink.split('/')[1:])):
-                                os.makedirs(hostname + '/' + '/'.join(newlink.split('/')[1:]))
-                            with open(hostname + '/' + '/'.join(newlink.split('/')[1:]) + '/index.html', 'w', encoding="utf-8") as f:
-                                f.write(html)
-                        else:
-                            if not os.path.exists(hostname + '/' + link.split('/')[-1]):
-                                os.makedirs(hostname + '/' + link.split('/')[-1])
-                            with open(hostname + '/' + link.split('/')[-1] + '/index.html', 'w', encoding="utf-8") as f:
-                                f.write(html)
-                    
-                        await save_links(page, await page.querySelectorAllEval('a', 'nodes => nodes.map(n => n.href)'))
-
-                    except Exception as e:
-                        # Check the error count, if over 3, add link to the seen list (ignore)
-                        if(link in errors):
-                            errors[link] += 1
-                        else:
-                            errors[link] = 1
-
-                        if(errors[link] > 3):
-                            seen.append(link)
-                            print("Error: " + link + ". Giving up after 3 attempts. Added to seen list.")
-                            continue
-
-                        print(e)
-                        print("Error: " + link + ". Try " + str(errors[link]) + " of 3")
+                        with tracer.span('page', category='page', url=link):
+                            html = await fix_page(page, wait, hostname, blockPrimaryFolder, darkWebsite, forceDownloadAgain, metatags, mapData, imageOptions, fontUsage, preloadBudget, maxDownloadSize, outputDir)
+                        links = await page.querySelectorAllEval('a', 'nodes => nodes.map(n => n.href)')
+
+                    # Write each page as index.html to a folder named after the page
+                    # Check if the hostname is nested inside another folder
+                    # Count number of slashes
+                    newlink = link.replace('https://', '').replace('http://', '')
+
+                    if(newlink.count('/') > 1 and blockPrimaryFolder not in newlink.split('/')[1]):
+                        # Create the folder
+                        if not os.path.exists(outputDir + '/' + '/'.join(newlink.split('/')[1:])):
+                            os.makedirs(outputDir + '/' + '/'.join(newlink.split('/')[1:]))
+                        with open(outputDir + '/' + '/'.join(newlink.split('/')[1:]) + '/index.html', 'w', encoding="utf-8") as f:
+                            f.write(html)
+                    else:
+                        if not os.path.exists(outputDir + '/' + link.split('/')[-1]):
+                            os.makedirs(outputDir + '/' + link.split('/')[-1])
+                        with open(outputDir + '/' + link.split('/')[-1] + '/index.html', 'w', encoding="utf-8") as f:
+                            f.write(html)
+
+                    metrics.set('pages_in_flight', 0, site=hostname)
+                    metrics.inc('pages_done', site=hostname)
+                    summary['pages'] += 1
+                    circuitWaits = 0
+                    enqueue(links)
+                    report_progress()
 
+                except CircuitOpenError as e:
+                    # The site or its CDN is failing, which isn't this page's fault: put it back without using
+                    # up an attempt, and wait for the host to recover rather than failing the rest of the frontier too
+                    metrics.set('pages_in_flight', 0, site=hostname)
+                    if link in seen:
+                        seen.remove(link)
+                    circuitWaits += 1
+                    if circuitWaits > config['maxCircuitWaits']:
+                        # The host isn't coming back, fail the site rather than wait forever
+                        print(f"Error: {e.host} is still failing after {config['maxCircuitWaits']} pauses, giving up on {site}")
+                        raise
+                    frontier.append(link)
+                    print(f"Waiting for {e.host}: {e}")
+                    await asyncio.sleep(e.retryIn)
+
+                except Exception as e:
+                    metrics.set('pages_in_flight', 0, site=hostname)
+                    metrics.inc('errors', site=hostname)
+                    summary['errors'] += 1
+
+                    # Check the error count, if over 3, add link to the seen list (ignore)
+                    if(link in errors):
+                        errors[link] += 1
+                    else:
+                        errors[link] = 1
+
+                    if(errors[link] > 3):
+                        seen.append(link)
+                        print("Error: " + link + ". Giving up after 3 attempts. Added to seen list.")
                         continue
 
-            await save_links(page, await page.querySelectorAllEval('a', 'nodes => nodes.map(n => n.href)'))
+                    # Try it again once the rest of the frontier is done
+                    if link in seen:
+                        seen.remove(link)
+                    frontier.insert(0, link)
+                    metrics.inc('retries', site=hostname)
+                    print(e)
+                    print("Error: " + link + ". Try " + str(errors[link]) + " of 3")
+
+        loop = asyncio.get_event_loop()
+
+        # Now that every page is saved, shrink the fonts to the characters the site uses
+        if(config['subsetFonts']):
+            with tracer.span('optimize_fonts', category='site', site=hostname):
+                await loop.run_in_executor(None, optimizeFonts, outputDir, fontUsage)
+
+        # Give the assets content-hashed names that can be cached forever, and write the cache headers
+        if(config['fingerprintAssets']):
+            with tracer.span('finalize', category='site', site=hostname):
+                await loop.run_in_executor(None, finalize_site, hostname, config['serviceWorker'], outputDir)
+
+        # Check the exported pages against the performance budgets
+        if config['budgets'] is not None:
+            with tracer.span('audit', category='site', site=hostname):
+                summary['violations'] = await loop.run_in_executor(None, run_audit, hostname, config['budgets'], outputDir)
     finally:
-        # Always close the browser, even if there's an error
-        if browser:
+        await manager.release(tab)
+
+    return summary
+
+
+def format_summary(summaries):
+    """Return a table of the per-site results of a run."""
+    lines = [f"{'Site':<50} {'Status':<8} {'Pages':>6} {'Errors':>6} {'Budget':>6} {'Time (s)':>9}"]
+    for summary in summaries:
+        lines.append(f"{summary['site'][:50]:<50} {summary['status']:<8} {summary['pages']:>6} {summary['errors']:>6} {summary['violations']:>6} {summary['seconds']:>9.1f}")
+    return '\n'.join(lines)
+
+
+async def main(configPath='config.json'):
+    """Main function to scrape one Wix website, or every site listed under "sites" with one shared browser.
+
+    Returns the number of performance budget violations found in the exported sites plus the number of sites that failed.
+    """
+    # Load the data from the json file
+    with open(configPath) as f:
+        data = json.load(f)
+
+    # Each entry of "sites" overrides the top-level settings for that site; without it the config is one site
+    batch = 'sites' in data
+    sites = [site_config(data, siteData) for siteData in data.get('sites', [{}])]
+    maxConcurrentSites = data.get('maxConcurrentSites', DEFAULT_MAX_CONCURRENT_SITES)
+
+    headless = data.get('headless', 'True').lower() == 'true'
+    executablePath = data.get('executablePath', find_browser())
+    browserArgs = data.get('browserArgs', [])
+    # Tabs are replaced after this many pages or above this much JavaScript heap (MB), the browser is
+    # restarted above this much resident memory (MB); 0 turns a limit off
+    recycleTabAfter = data.get('recycleTabAfter', DEFAULT_RECYCLE_TAB_AFTER)
+    maxTabHeap = data.get('maxTabHeap', DEFAULT_MAX_TAB_HEAP)
+    maxBrowserRSS = data.get('maxBrowserRSS', DEFAULT_MAX_BROWSER_RSS)
+
+    # Where the timing of every page and stage is written, for chrome://tracing or Perfetto
+    traceFile = data.get('traceFile', 'batch.trace.json' if batch else sites[0]['hostname'] + '.trace.json')
+    tracer.configure(data.get('maxTraceEvents', DEFAULT_MAX_TRACE_EVENTS))
+    # Where the per-site results are written as JSON, if anywhere
+    summaryFile = data.get('summaryFile')
+
+    # Pacing, backoff and circuit breaking of requests to each host, see ratelimit.py
+    limiter.configure(**data.get('rateLimit', {}))
+
+    # Live metrics, served for Prometheus and/or written for node_exporter's textfile collector
+    metricsPort = data.get('metricsPort')
+    metricsFile = data.get('metricsFile')
+    if metricsPort:
+        metrics.serve(metricsPort, data.get('metricsHost', '127.0.0.1'))
+
+    def report_progress():
+        print(metrics.progress_line())
+        if metricsFile:
+            metrics.write_textfile(metricsFile)
+
+    summaries = []
+
+    # Use the configured browser, or else the first Chromium, Chrome or Edge found (None for pyppeteer's own Chromium),
+    # set width and height to 1920x1080
+    launchOptions = {'headless': headless, 'defaultViewport': None, 'args': LEAN_BROWSER_ARGS + ['--window-size=1920,1080'] + browserArgs}
+    if executablePath:
+        launchOptions['executablePath'] = executablePath
+    # One pre-warmed context per site crawled at the same time
+    manager = BrowserManager(launchOptions, min(maxConcurrentSites, len(sites)), recycleTabAfter, maxTabHeap, maxBrowserRSS)
+    try:
+        await manager.start()
+
+        # Sites wait for a free context, so at most maxConcurrentSites crawl at once; the image encoder
+        # pool and download cache are shared by all of them
+        async def run_site(config):
+            start = time.monotonic()
             try:
-                await browser.close()
-                # Give pyppeteer time to clean up
-                await asyncio.sleep(0.1)
+                summary = await crawl_site(manager, config, report_progress)
+                summary['status'] = 'ok'
             except Exception as e:
-                print(f"Warning: Error closing browser: {e}")
+                # One broken site doesn't stop the rest of the batch
+                if not batch:
+                    raise
+                print(f"Error: {config['site']} failed: {e}")
+                summary = {'site': config['site'], 'pages': 0, 'errors': 0, 'violations': 0, 'status': 'failed', 'error': str(e)}
+            summary['seconds'] = time.monotonic() - start
+            return summary
+
+        # Every site gets its own task, and so its own row in the trace
+        summaries = await asyncio.gather(*(run_site(config) for config in sites))
+    finally:
+        # Always close the browser, even if there's an error
+        await manager.close()
+
+        # Report where the time went
+        print(tracer.summary())
+        try:
+            tracer.export_chrome_trace(traceFile)
+            print("Trace written to " + traceFile)
+        except OSError as e:
+            print(f"Warning: Could not write trace: {e}")
+
+    # Report how each site went
+    print(format_summary(summaries))
+    if summaryFile:
+        with open(summaryFile, 'w', encoding='utf-8') as f:
+            json.dump(summaries, f, indent=2)
+
+    return sum(summary['violations'] for summary in summaries) + sum(1 for summary in summaries if summary['status'] != 'ok')
@@ -0,0 +1,48 @@
+"""Tests for the performance-budget auditor."""
+import os
+import tempfile
+import unittest
+
+from audit import audit_page, srcset_urls
+
+
+class SrcsetTest(unittest.TestCase):
+
+    def test_every_candidate(self):
+        self.assertEqual(srcset_urls('/a.webp 320w, /b.webp 640w,/c.webp 2x'), ['/a.webp', '/b.webp', '/c.webp'])
+
+    def test_commas_inside_urls(self):
+        self.assertEqual(srcset_urls('data:image/png;base64,AA,BB 1x, /x.png 2x'), ['data:image/png;base64,AA,BB', '/x.png'])
+
+
+class ImageWeightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        os.makedirs(os.path.join(self.root, 'images'))
+        for name, size in (('hero.320.jpg', 100), ('hero.1280.jpg', 400), ('hero.1920.avif', 900), ('hero.640.avif', 200)):
+            with open(os.path.join(self.root, 'images', name), 'wb') as f:
+                f.write(b'x' * size)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def audit(self, body):
+        with open(os.path.join(self.root, 'index.html'), 'w', encoding='utf-8') as f:
+            f.write('<html><head></head><body>' + body + '</body></html>')
+        return audit_page(self.root, 'example.com', os.path.join(self.root, 'index.html'))
+
+    def test_counts_the_largest_srcset_candidate(self):
+        page = self.audit('<img src="/images/hero.320.jpg" srcset="/images/hero.320.jpg 320w, /images/hero.1280.jpg 1280w" width="320" height="200">')
+        self.assertEqual(page['images'], 400)
+
+    def test_counts_picture_sources(self):
+        page = self.audit('<picture><source type="image/avif" srcset="/images/hero.640.avif 640w, /images/hero.1920.avif 1920w">'
+                          '<img src="/images/hero.320.jpg" width="320" height="200"></picture>')
+        self.assertEqual(page['images'], 900)
+        self.assertEqual(page['imagesMissingDimensions'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
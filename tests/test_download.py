@@ -0,0 +1,107 @@
+"""Tests for resumable downloads."""
+import os
+import hashlib
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from utils import download_file, DownloadIntegrityError
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves server.body with a strong ETag, honouring Range, and If-Range unless server.ignoreIfRange."""
+
+    def do_GET(self):
+        body = self.server.body
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        start = 0
+        rangeHeader = self.headers.get('Range')
+        if rangeHeader and (self.server.ignoreIfRange or self.headers.get('If-Range') == etag):
+            start = int(rangeHeader.split('=')[1].split('-')[0])
+
+        self.send_response(206 if start else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        if start:
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.ignoreIfRange = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1]) + '/video.mp4'
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'video.mp4')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def leave_partial(self, body, validator):
+        with open(self.path + '.part', 'wb') as f:
+            f.write(body[:10])
+        if validator:
+            with open(self.path + '.part.validator', 'w') as f:
+                f.write('"' + hashlib.md5(body).hexdigest() + '"')
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_resumes_the_same_version(self):
+        self.server.body = b'0123456789abcdefghij'
+        self.leave_partial(self.server.body, validator=True)
+        download_file(self.url, self.path)
+        self.assertEqual(self.read(), self.server.body)
+        self.assertFalse(os.path.exists(self.path + '.part.validator'))
+
+    def test_starts_over_when_the_file_changed(self):
+        self.leave_partial(b'OLD-OLD-OLD-OLD-OLD-OLD-OLD', validator=True)
+        self.server.body = b'0123456789abcdefghij'
+        download_file(self.url, self.path)
+        self.assertEqual(self.read(), self.server.body)
+
+    def test_starts_over_when_the_server_ignores_if_range(self):
+        self.leave_partial(b'OLD-OLD-OLD-OLD-OLD-OLD-OLD', validator=True)
+        self.server.body = b'0123456789abcdefghij'
+        self.server.ignoreIfRange = True
+        download_file(self.url, self.path)
+        self.assertEqual(self.read(), self.server.body)
+
+    def test_starts_over_without_a_validator(self):
+        self.leave_partial(b'OLD-OLD-OLD-OLD-OLD-OLD-OLD', validator=False)
+        self.server.body = b'0123456789abcdefghij'
+        download_file(self.url, self.path)
+        self.assertEqual(self.read(), self.server.body)
+
+
+class RetryTest(unittest.TestCase):
+
+    def test_retries_a_corrupted_download(self):
+        with mock.patch('utils._download_once', side_effect=[DownloadIntegrityError('short'), 20]) as attempt:
+            self.assertEqual(download_file('https://example.com/video.mp4', '/nonexistent/video.mp4'), 20)
+        self.assertEqual(attempt.call_count, 2)
+
+    def test_does_not_retry_other_errors(self):
+        for error in (requests.exceptions.InvalidURL('bad'), requests.exceptions.TooManyRedirects('loop'), OSError(28, 'No space left on device')):
+            with mock.patch('utils._download_once', side_effect=error) as attempt:
+                with self.assertRaises(type(error)):
+                    download_file('https://example.com/video.mp4', '/nonexistent/video.mp4')
+            self.assertEqual(attempt.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""Tests for the output finalization stage."""
+import os
+import unittest
+import tempfile
+
+from finalize import finalize_site, asset_exists
+
+
+class FingerprintAssetsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs('example.com/images')
+        with open('example.com/images/logo.png', 'wb') as f:
+            f.write(b'local logo')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_external_urls_with_the_same_path_are_left_alone(self):
+        with open('example.com/index.html', 'w', encoding='utf-8') as f:
+            f.write('<html><body><img src="/images/logo.png">'
+                    '<img src="https://partner.example.com/images/logo.png">'
+                    '<div style="background-image: url(&quot;/images/logo.png&quot;)"></div></body></html>')
+
+        finalize_site('example.com')
+
+        with open('example.com/index.html', encoding='utf-8') as f:
+            html = f.read()
+        [name] = os.listdir('example.com/images')
+        self.assertRegex(name, r'^logo\.[0-9a-f]{10}\.png$')
+        self.assertIn('src="/images/' + name + '"', html)
+        self.assertIn('url(&quot;/images/' + name + '&quot;)', html)
+        self.assertIn('src="https://partner.example.com/images/logo.png"', html)
+
+    def test_headers_cache_the_asset_folders_once_only_fingerprinted_files_are_left(self):
+        with open('example.com/images/unused.png', 'wb') as f:
+            f.write(b'not referenced')
+        with open('example.com/index.html', 'w', encoding='utf-8') as f:
+            f.write('<html><body><img src="/images/logo.png"></body></html>')
+
+        finalize_site('example.com')
+
+        [name] = os.listdir('example.com/images')
+        self.assertRegex(name, r'^logo\.[0-9a-f]{10}\.png$')
+        with open('example.com/_headers', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        rules = dict(zip(lines[0::2], lines[1::2]))
+        self.assertEqual(rules, {
+            '/images/*': '  Cache-Control: public, max-age=31536000, immutable',
+            '/sw.js': '  Cache-Control: no-cache',
+        })
+
+    def test_reruns_reuse_the_fingerprinted_files(self):
+        with open('example.com/index.html', 'w', encoding='utf-8') as f:
+            f.write('<html><body><img src="/images/logo.png"></body></html>')
+        finalize_site('example.com')
+        [name] = os.listdir('example.com/images')
+
+        # The next run finds the image already written and keeps referring to it by its own name
+        self.assertTrue(asset_exists('example.com', '/images/logo.png'))
+        with open('example.com/index.html', 'w', encoding='utf-8') as f:
+            f.write('<html><body><img src="/images/logo.png"></body></html>')
+        finalize_site('example.com')
+
+        with open('example.com/index.html', encoding='utf-8') as f:
+            self.assertIn('src="/images/' + name + '"', f.read())
+        self.assertEqual(os.listdir('example.com/images'), [name])
+
+    def test_output_dir(self):
+        os.makedirs('exports')
+        os.replace('example.com', 'exports/example')
+        with open('exports/example/index.html', 'w', encoding='utf-8') as f:
+            f.write('<html><body><img src="/images/logo.png"></body></html>')
+
+        finalize_site('example.com', outputDir='exports/example')
+
+        self.assertTrue(os.path.exists('exports/example/_headers'))
+        self.assertTrue(os.path.exists('exports/example.nginx.conf'))
+        self.assertRegex(os.listdir('exports/example/images')[0], r'^logo\.[0-9a-f]{10}\.png$')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""Tests for image processing."""
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+from asset_handlers import svgDimensions, loadEncodeCache, saveEncodeCache, processImage, fetchImage
+from utils import hash_file
+
+
+class SvgDimensionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'icon.svg')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def dimensions(self, svg):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(svg)
+        return svgDimensions(self.path)
+
+    def test_width_and_height_in_pixels(self):
+        self.assertEqual(self.dimensions('<svg xmlns="http://www.w3.org/2000/svg" width="24px" height="12"></svg>'), ('24', '12'))
+
+    def test_falls_back_to_the_view_box(self):
+        self.assertEqual(self.dimensions('<?xml version="1.0"?><svg width="100%" viewBox="0 0 300.4 150"><g/></svg>'), ('300', '150'))
+
+    def test_no_size_at_all(self):
+        self.assertIsNone(self.dimensions('<svg></svg>'))
+        self.assertIsNone(self.dimensions('not an svg'))
+
+
+class ProcessImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.outputDir = os.path.join(self.tmp.name, 'example.com')
+        os.makedirs(os.path.join(self.outputDir, 'images'))
+        self.options = {'responsiveWidths': [320], 'imageFormats': ['webp'], 'imageQualities': [80],
+                        'minImageQuality': 0, 'cacheDir': os.path.join(self.tmp.name, 'cache')}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def original(self, size, color):
+        path = os.path.join(self.tmp.name, color + '.png')
+        Image.new('RGB', size, color).save(path)
+        return 'a~mv2.png', path, hash_file(path)
+
+    def size_of(self, src):
+        with Image.open(self.outputDir + src) as im:
+            return im.size
+
+    def test_crops_with_the_same_filename_keep_their_own_files(self):
+        # Two crops of one Wix media item: different contents, same filename
+        wide = processImage('https://static.wixstatic.com/media/a~mv2.png/v1/fill/w_1600,h_1000/a~mv2.png',
+                            self.original((1600, 1000), 'red'), self.outputDir, 800, self.options, False)
+        tall = processImage('https://static.wixstatic.com/media/a~mv2.png/v1/fill/w_400,h_900/a~mv2.png',
+                            self.original((400, 900), 'blue'), self.outputDir, 400, self.options, False)
+
+        self.assertNotEqual(wide['attributes']['src'], tall['attributes']['src'])
+        self.assertEqual((wide['attributes']['width'], wide['attributes']['height']), ('1600', '1000'))
+        self.assertEqual((tall['attributes']['width'], tall['attributes']['height']), ('400', '900'))
+        self.assertEqual(self.size_of(wide['attributes']['src']), (1600, 1000))
+        self.assertEqual(self.size_of(tall['attributes']['src']), (400, 900))
+        # Every srcset entry points at a file of the width it claims
+        for result in (wide, tall):
+            for entry in result['attributes'].get('srcset', '').split(', '):
+                if entry:
+                    src, width = entry.split()
+                    self.assertEqual(self.size_of(src)[0], int(width[:-1]))
+
+
+class FetchImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_sites_fetching_the_same_image_at_once_share_the_download(self):
+        def slow_download(url, path, maxSize=None, timeout=30, reserved=False):
+            with open(path, 'ab') as f:
+                for chunk in (b'GIF89a', b'-image'):
+                    time.sleep(0.05)
+                    f.write(chunk)
+
+        results, errors = [], []
+
+        def fetch():
+            try:
+                results.append(fetchImage('https://static.wixstatic.com/media/a.gif', self.tmp.name))
+            except Exception as e:
+                errors.append(e)
+
+        with mock.patch('asset_handlers.download_file', slow_download):
+            threads = [threading.Thread(target=fetch) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        [(_, path, _)] = set(results)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'GIF89a-image')
+
+
+class EncodeCacheTest(unittest.TestCase):
+
+    def test_one_cache_per_cache_dir(self):
+        with tempfile.TemporaryDirectory() as first, tempfile.TemporaryDirectory() as second:
+            loadEncodeCache(first)['urls']['https://example.com/a.png'] = {'name': 'a.png', 'hash': '0'}
+            saveEncodeCache(first)
+            self.assertEqual(loadEncodeCache(second)['urls'], {})
+            self.assertTrue(os.path.exists(os.path.join(first, 'image-encodings.json')))
+            self.assertFalse(os.path.exists(os.path.join(second, 'image-encodings.json')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+"""Tests for the timing instrumentation."""
+import json
+import os
+import tempfile
+import unittest
+
+from instrumentation import Tracer
+
+
+class TracerTest(unittest.TestCase):
+
+    def test_keeps_only_the_latest_events(self):
+        tracer = Tracer(maxEvents=10)
+        for _ in range(25):
+            with tracer.span('page'):
+                pass
+            tracer.count('downloads')
+
+        self.assertEqual(len(tracer.events), 10)
+        self.assertEqual(tracer.dropped, 40)
+        # Totals and counters still cover every span
+        self.assertEqual(tracer.stage_totals()['page'][0], 25)
+        self.assertEqual(tracer.counters['downloads'], 25)
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'trace.json')
+            tracer.export_chrome_trace(path)
+            with open(path, encoding='utf-8') as f:
+                events = json.load(f)['traceEvents']
+        self.assertEqual(len([event for event in events if event['ph'] != 'M']), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,25 @@
 """Utility functions for Wix Scraper."""
+import os
+import base64
+import hashlib
 import asyncio
+import requests
+from instrumentation import tracer
+from metrics import metrics
+from ratelimit import limiter, THROTTLE_STATUSES
+
+
+# Size of each chunk read from the network and written to disk
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# Attempts at a download that was throttled, cut off or couldn't connect
+DOWNLOAD_ATTEMPTS = 4
+
+# Shared so downloads reuse connections to the Wix CDNs
+session = requests.Session()
+
+
+class DownloadIntegrityError(IOError):
+    """Raised when a downloaded file is shorter than announced or fails its checksum."""
 
 
 async def scroll_to_bottom(page):
@@ -9,3 +29,152 @@ async def scroll_to_bottom(page):
         await page.evaluate(f'window.scrollTo(0, {i})')
         await asyncio.sleep(0.1)
     await asyncio.sleep(1)
+
+
+def download_file(url, path, maxSize=None, timeout=30, reserved=False):
+    """Stream a URL to path through a .part file, resuming a previous partial download with a Range request.
+
+    A resume is only attempted with the ETag or Last-Modified the partial download started with, sent as
+    If-Range, so a file that changed on the server in the meantime is downloaded again from the start.
+
+    The body is never held in memory. The size (and MD5, when the server sends one) is verified before
+    the file is atomically renamed into place. Raises ValueError if the file is larger than maxSize bytes.
+
+    Requests are paced by the per-host rate limiter. Throttled (429/5xx), cut off, corrupted and failed
+    connections are retried, resuming where they stopped, up to DOWNLOAD_ATTEMPTS times; any other error
+    (a bad URL, too many redirects, a full disk, ...) is raised straight away. Raises CircuitOpenError
+    while the host's circuit is open. Returns the size of the file. With reserved, the caller has already
+    waited for the first request's slot with limiter.acquire.
+    """
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        if attempt > 1 or not reserved:
+            limiter.wait(url)
+        try:
+            return _download_once(url, path, maxSize, timeout)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code not in THROTTLE_STATUSES or attempt == DOWNLOAD_ATTEMPTS:
+                raise
+        except (requests.ConnectionError, requests.Timeout):
+            limiter.record(url, error=True)
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError, DownloadIntegrityError):
+            # Cut off or corrupted, the next attempt resumes or starts over
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+        print(f"Warning: Retrying download of {url} (attempt {attempt + 1} of {DOWNLOAD_ATTEMPTS})")
+
+
+def _remove_partial(partPath):
+    """Delete a partial download and the validator saved with it."""
+    for leftover in (partPath, partPath + '.validator'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def _download_once(url, path, maxSize, timeout):
+    """Make one attempt at download_file."""
+    partPath = path + '.part'
+    existing = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+
+    # The ETag or Last-Modified of the version the partial file holds the start of
+    validator = None
+    if existing:
+        try:
+            with open(partPath + '.validator', encoding='utf-8') as f:
+                validator = f.read().strip()
+        except OSError:
+            pass
+        if not validator:
+            # Nothing to check the rest against, start over
+            _remove_partial(partPath)
+            existing = 0
+
+    # Ask for the raw bytes, content-encoding would break both resuming and the size check
+    headers = {'Accept-Encoding': 'identity'}
+    if existing:
+        headers['Range'] = 'bytes=' + str(existing) + '-'
+        # The server answers 200 with the whole file instead if it changed since
+        headers['If-Range'] = validator
+
+    with session.get(url, headers=headers, stream=True, allow_redirects=True, timeout=timeout) as r:
+        retryAfter = r.headers.get('Retry-After', '')
+        limiter.record(url, r.elapsed.total_seconds(), r.status_code, retryAfter=int(retryAfter) if retryAfter.isdigit() else None)
+        if r.status_code == 416:
+            # The partial file already holds everything, start over to be able to verify it
+            _remove_partial(partPath)
+            return _download_once(url, path, maxSize, timeout)
+        r.raise_for_status()
+
+        etag = r.headers.get('ETag', '')
+        # Weak ETags can't be used with If-Range
+        newValidator = etag if etag and not etag.startswith('W/') else r.headers.get('Last-Modified')
+        if r.status_code == 206 and newValidator and newValidator != validator:
+            # The server sent the rest of a different version, the partial file is useless
+            _remove_partial(partPath)
+            return _download_once(url, path, maxSize, timeout)
+
+        if r.status_code == 206:
+            mode = 'ab'
+            total = r.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+            total = int(total) if total.isdigit() else None
+        else:
+            # The server ignored the Range header, the whole file is coming again
+            mode = 'wb'
+            existing = 0
+            total = int(r.headers['Content-Length']) if r.headers.get('Content-Length', '').isdigit() else None
+            if newValidator:
+                with open(partPath + '.validator', 'w', encoding='utf-8') as f:
+                    f.write(newValidator)
+            elif os.path.exists(partPath + '.validator'):
+                os.remove(partPath + '.validator')
+
+        if maxSize is not None and total is not None and total > maxSize:
+            raise ValueError(f"{url} is {total} bytes, over the {maxSize} byte limit")
+
+        size = existing
+        with open(partPath, mode) as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if maxSize is not None and size > maxSize:
+                    f.close()
+                    _remove_partial(partPath)
+                    raise ValueError(f"{url} is over the {maxSize} byte limit")
+                f.write(chunk)
+
+        expectedMd5 = None
+        for part in r.headers.get('x-goog-hash', '').split(','):
+            if part.strip().startswith('md5='):
+                expectedMd5 = part.strip()[len('md5='):]
+        expectedMd5 = expectedMd5 or r.headers.get('Content-MD5')
+
+    if total is not None and size != total:
+        # Keep the partial file, the next attempt resumes from here
+        raise DownloadIntegrityError(f"Incomplete download of {url}: got {size} of {total} bytes")
+
+    if expectedMd5 and base64.b64encode(bytes.fromhex(hash_file(partPath, 'md5'))).decode('ascii') != expectedMd5:
+        _remove_partial(partPath)
+        raise DownloadIntegrityError(f"Checksum mismatch downloading {url}")
+
+    os.replace(partPath, path)
+    if os.path.exists(partPath + '.validator'):
+        os.remove(partPath + '.validator')
+    tracer.count('downloads')
+    tracer.count('download_bytes', size - existing)
+    metrics.inc('bytes_fetched', size - existing)
+    return size
+
+
+def hash_file(path, algorithm='sha1'):
+    """Return the hex digest of a file, read in chunks."""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def page_url(outputDir, path):
+    """Return the URL a page saved as <outputDir>/<folder>/index.html is served at."""
+    folder = os.path.relpath(os.path.dirname(path), outputDir).replace(os.sep, '/')
+    return '/' if folder == '.' else '/' + folder + '/'
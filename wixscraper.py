@@ -2,9 +2,11 @@
 
 This script scrapes Wix websites and converts them to offline static sites.
 """
+import sys
 import asyncio
 from scraper import main
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Exit non-zero if a site failed or an exported site is over its performance budgets
+    sys.exit(1 if asyncio.run(main()) else 0)